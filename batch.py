@@ -0,0 +1,111 @@
+import argparse
+import glob
+import json
+import os
+import time
+import warnings
+from main import add_render_arguments, open_tiles, open_track_cache
+
+
+def find_gpx(paths: list[str]) -> list[str]:
+    # GPX files given directly, found below directories, or listed one per line in
+    # manifests, relative to the manifest
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "**", "*.gpx"), recursive=True)))
+        elif path.lower().endswith(".gpx"):
+            files.append(path)
+        else:
+            with open(path, "r") as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith("#"): files.append(os.path.join(os.path.dirname(path), line))
+    return files
+
+
+def output_name(output_dir: str, filename: str, track: int, tracks: int, base: str=None) -> str:
+    # Relative to base, the directory the GPX files of a batch have in common, so that
+    # files of the same name in different directories get guides of their own
+    name = os.path.splitext(os.path.relpath(filename, base) if base != None else os.path.basename(filename))[0]
+    if tracks > 1: name = f"{name}-{track}"
+    return os.path.join(output_dir, f"{name}.pdf")
+
+
+def common_dir(files: list[str]) -> str:
+    return os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in files]) if files else None
+
+
+def render_batch(files: list[str], output_dir: str, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, workers: int=None, tile_source=None, compression: str="jpeg", incremental: bool=False, track_cache=None, vector: bool=False, max_memory: int=None) -> dict:
+    # One guide per track of every file. All routes share the process wide fonts,
+    # sprite, tile and decoded tile caches, HTTP session and one pool of render
+    # workers. A failing route is recorded in the summary and the batch goes on, so is
+    # a route whose guide would overwrite the one of an earlier route.
+    # Incremental batches only render the pages of a guide that changed. With a
+    # TrackCache, files parsed in an earlier batch are loaded from it. max_memory
+    # bounds the pages in flight and the caches of the workers, see render_pages.
+
+    from data import GeoData
+    from guide import page_executor, render_guide, save_guide, update_guide
+
+    if workers == None: workers = os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    routes = list()
+    base = common_dir(files)
+    outputs = set()
+    executor = page_executor(workers, max_memory) if workers > 1 else None
+    try:
+        for filename in files:
+            try:
+                tracks = track_cache.get(filename) if track_cache != None else GeoData.from_gpx(filename, stream=True)
+            except Exception as e:
+                routes.append({"gpx": filename, "track": None, "output": None, "pages": 0, "rendered": 0, "time": 0, "warnings": [], "error": f"{type(e).__name__}: {e}"})
+                continue
+            for i, track in enumerate(tracks):
+                route = {"gpx": filename, "track": i, "output": output_name(output_dir, os.path.abspath(filename), i, len(tracks), base), "pages": 0, "rendered": 0, "time": 0, "warnings": [], "error": None}
+                if route["output"] in outputs:
+                    route["error"] = f"duplicate output {route['output']}"
+                    routes.append(route)
+                    continue
+                outputs.add(route["output"])
+                os.makedirs(os.path.dirname(route["output"]) or ".", exist_ok=True)
+                route_start = time.perf_counter()
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    try:
+                        if incremental:
+                            route.update(update_guide(route["output"], [track], scale, paper_size, dpi, margin, workers=workers, max_memory=max_memory, tile_source=tile_source, compression=compression, executor=executor, vector=vector))
+                        else:
+                            pages = render_guide(track, scale, paper_size, dpi, margin, workers=workers, max_memory=max_memory, tile_source=tile_source, executor=executor, vector=vector)
+                            route["pages"] = route["rendered"] = save_guide(route["output"], pages, dpi, compression)
+                    except Exception as e:
+                        route["error"] = f"{type(e).__name__}: {e}"
+                route["time"] = time.perf_counter() - route_start
+                route["warnings"] = [str(warning.message) for warning in caught]
+                routes.append(route)
+    finally:
+        if executor != None: executor.shutdown()
+    return {"routes": routes, "pages": sum(route["pages"] for route in routes), "rendered": sum(route["rendered"] for route in routes), "failed": sum(route["error"] != None for route in routes), "time": time.perf_counter() - start}
+
+
+def main(argv: list[str]=None) -> dict:
+    parser = argparse.ArgumentParser(description="Render one PDF guide per track of many GPX files in one process")
+    parser.add_argument("inputs", nargs="+", help="GPX files, directories searched for *.gpx, or manifests listing one GPX file per line")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory of the PDF guides")
+    parser.add_argument("--summary", help="JSON summary file, printed by default")
+    add_render_arguments(parser)
+    args = parser.parse_args(argv)
+
+    max_memory = int(args.max_memory*2**20) if args.max_memory != None else None
+    summary = render_batch(find_gpx(args.inputs), args.output_dir, (1, args.scale), tuple(args.paper), args.dpi, args.margin, args.workers, open_tiles(args.tiles), args.compression, args.incremental, open_track_cache(args.track_cache), args.vector, max_memory)
+    if args.summary != None:
+        with open(args.summary, "w") as file:
+            json.dump(summary, file, indent=1)
+    else:
+        print(json.dumps(summary, indent=1))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
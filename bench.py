@@ -0,0 +1,139 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from guide import *
+
+
+class FakeTileSource(TileSource):
+
+    # Deterministic local tiles, encoded once per key so that only decoding and
+    # compositing are measured
+
+
+    def __init__(self) -> None:
+        self._tiles = dict()
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        key = (zoom, x, y)
+        if key not in self._tiles:
+            tile_img = Image.new("RGB", (256, 256), ((x*37) % 256, (y*53) % 256, (zoom*10) % 256))
+            ImageDraw.Draw(tile_img).line([0, 0, 255, 255], fill="white", width=3)
+            buffer = BytesIO()
+            tile_img.save(buffer, "PNG")
+            self._tiles[key] = buffer.getvalue()
+        return self._tiles[key]
+
+
+def measure(func, setup=None, repeat: int=5) -> dict:
+    # Best and mean wall time over repeat runs, peak memory traced by tracemalloc (Python and NumPy
+    # allocations, not PIL image buffers) of one more run
+    times = list()
+    for _ in range(repeat):
+        if setup != None: setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup != None: setup()
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"time": min(times), "mean_time": sum(times)/len(times), "peak_traced_memory": peak_memory}
+
+
+def bench_file(filename: str, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, pages: int, repeat: int) -> dict:
+
+    results = dict()
+    results["from_gpx"] = measure(lambda: GeoData.from_gpx(filename), repeat=repeat)
+    results["from_gpx_stream"] = measure(lambda: GeoData.from_gpx(filename, stream=True), repeat=repeat)
+    with tempfile.TemporaryDirectory() as tmp:
+        for dtype in ("float64", "float32"):
+            track_cache = TrackCache(tmp, dtype)
+            clear = lambda: [os.remove(os.path.join(tmp, name)) for name in os.listdir(tmp)]
+            results[f"track_cache_cold_{dtype}"] = measure(lambda: track_cache.get(filename), clear, repeat)
+            results[f"track_cache_warm_{dtype}"] = measure(lambda: track_cache.get(filename), repeat=repeat)
+    track = GeoData.from_gpx(filename, tracks=[0], stream=True)[0]
+    results["points"] = track.len
+    geo_coords = [GeoCoord(lat, lon) for lat, lon in zip(track.lat, track.lon)]
+    results["from_geo"] = measure(lambda: GeoData.from_geo(geo_coords), repeat=repeat)
+    results["from_arrays"] = measure(lambda: GeoData.from_arrays(track.lat, track.lon), repeat=repeat)
+
+    map = Map(track.mean(), scale, paper_size, dpi)
+    paper_width, paper_height = paper_size
+    dx = map.paper2mercator_dist(paper_width - 2*margin)
+    dy = map.paper2mercator_dist(paper_height - 2*margin)
+    results["segment"] = measure(lambda: track.segment(dx, dy), repeat=repeat)
+    segments = track.segment(dx, dy)
+    results["pages"] = len(segments)
+    segments = segments[:pages]
+
+    delta = int(np.ceil(map.paper2geo_dist(2)))
+    dists = [range(int(np.min(segment.dist)), int(np.max(segment.dist))+1, delta) for segment in segments]
+    results["find_dists"] = measure(lambda: [segment.find_dists(dist) for segment, dist in zip(segments, dists)], repeat=repeat)
+
+    tile_source = FakeTileSource()
+    maps = [page_map(segment, scale, paper_size, dpi, tile_source) for segment in segments]
+    def map_tiles():
+        tile_cache = DecodedTileCache()
+        for map in maps:
+            map.tile_cache = tile_cache
+            map.map()
+    results["map"] = measure(map_tiles, repeat=repeat)
+
+    def fresh_imgs():
+        for map in maps: map.img = Img(map.lims, map.paper_size, map.dpi)
+    results["lines"] = measure(lambda: [map.img.lines(segment.x, segment.y, "red") for map, segment in zip(maps, segments)], fresh_imgs, repeat)
+    neighbours = [segments[i+1] if i < len(segments)-1 else segments[i-1] for i in range(len(segments))]
+    results["dotted"] = measure(lambda: [map.img.dotted(segment.x, segment.y, "red") for map, segment in zip(maps, neighbours)], fresh_imgs, repeat)
+    def annotate():
+        for map, segment, dist in zip(maps, segments, dists):
+            _, _, x, y, angle = segment.find_dists(dist)
+            for d, x, y, angle in zip(dist, x, y, np.rad2deg(angle + np.pi/2)):
+                if np.isnan(x): continue
+                map.img.mark(x, y, "red", angle)
+                map.img.annotate(x, y, str(d), "black", angle)
+    results["annotate"] = measure(annotate, lambda: (fresh_imgs(), Img._sprites.clear()), repeat)
+
+    imgs = [map.img.img for map in maps]
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, "bench.pdf")
+        results["save"] = measure(lambda: imgs[0].save(name, save_all=True, append_images=imgs[1:]), repeat=repeat)
+        results["save_stream"] = measure(lambda: save_guide(name, iter(imgs), dpi), repeat=repeat)
+        results["pdf_size"] = os.path.getsize(name)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time and memory-profile each stage of guide generation with a local fake tile source")
+    parser.add_argument("gpx", nargs="*", help="GPX files, all of gpx/ by default")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    parser.add_argument("--scale", type=int, default=20000, help="map scale 1:SCALE")
+    parser.add_argument("--paper", type=float, nargs=2, default=(14.8, 21), metavar=("WIDTH", "HEIGHT"), help="paper size in cm")
+    parser.add_argument("--dpi", type=float, default=200)
+    parser.add_argument("--margin", type=float, default=1, help="page margin in cm")
+    parser.add_argument("--pages", type=int, default=5, help="pages per file for the drawing stages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    filenames = args.gpx if args.gpx else sorted(glob.glob("gpx/*.gpx"))
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                       "scale": args.scale, "paper": args.paper, "dpi": args.dpi, "margin": args.margin, "pages": args.pages, "repeat": args.repeat},
+              "results": dict()}
+    for filename in filenames:
+        print(filename, file=sys.stderr)
+        report["results"][os.path.basename(filename)] = bench_file(filename, (1, args.scale), tuple(args.paper), args.dpi, args.margin, args.pages, args.repeat)
+
+    if args.output == None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
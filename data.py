@@ -1,5 +1,10 @@
-import gpxpy
-from scipy.optimize import root
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from array import array
+from datetime import datetime, timezone
+from profiling import *
 from units import *
 
 
@@ -16,26 +21,44 @@ class GeoData:
 
     @classmethod
     def from_geo(cls, geo_coords: list[GeoCoord]):
-        lat = np.array([geo_coord.lat for geo_coord in geo_coords])
-        lon = np.array([geo_coord.lon for geo_coord in geo_coords])
-        x = np.array([geo_coord.to_mercator().x for geo_coord in geo_coords])
-        y = np.array([geo_coord.to_mercator().y for geo_coord in geo_coords])
-        func = lambda a: a[0].dist(a[1])
-        delta = np.insert(np.apply_along_axis(func, 1, np.column_stack((geo_coords[:-1], geo_coords[1:]))), 0, 0)
+        lat = np.array([geo_coord.lat for geo_coord in geo_coords], dtype=float)
+        lon = np.array([geo_coord.lon for geo_coord in geo_coords], dtype=float)
+        return cls.from_arrays(lat, lon)
+
+    @classmethod
+    @profiled("data.from_arrays")
+    def from_arrays(cls, lat: np.ndarray, lon: np.ndarray):
+        geo_coords = GeoCoordArray(lat, lon)
+        mercator_coords = geo_coords.to_mercator()
+        delta = np.empty(len(geo_coords))
+        delta[:1] = 0
+        delta[1:] = geo_coords[:-1].dist(geo_coords[1:])
         dist = np.cumsum(delta)
-        return cls(lat, lon, x, y, dist)
+        return cls(geo_coords.lat, geo_coords.lon, mercator_coords.x, mercator_coords.y, dist)
+
+    @property
+    def geo_coords(self) -> GeoCoordArray:
+        return GeoCoordArray(self.lat, self.lon)
+    @property
+    def mercator_coords(self) -> MercatorCoordArray:
+        return MercatorCoordArray(self.x, self.y)
 
     @classmethod
-    def from_gpx(cls, filename: str):
+    @profiled("data.from_gpx")
+    def from_gpx(cls, filename: str, tracks: list[int]=None, stream: bool=False):
+
+        if stream:
+            return [cls.from_arrays(track["lat"], track["lon"]) for track in read_gpx(filename, tracks)]
 
+        import gpxpy
         geo_data = list()
         with open(filename, "r") as file:
             gpx = gpxpy.parse(file)
-            for track in gpx.tracks:
-                geo_coords = list()
-                for segment in track.segments:
-                    geo_coords.extend([GeoCoord(point.latitude, point.longitude) for point in segment.points])
-                geo_data.append(cls.from_geo(geo_coords))
+            for i, track in enumerate(gpx.tracks):
+                if tracks != None and i not in tracks: continue
+                lat = [point.latitude for segment in track.segments for point in segment.points]
+                lon = [point.longitude for segment in track.segments for point in segment.points]
+                geo_data.append(cls.from_arrays(lat, lon))
         
         return geo_data
     
@@ -54,87 +77,234 @@ class GeoData:
         return (self.min() + self.max())/2
 
 
+    @profiled("data.segment")
     def segment(self, delta_x: float, delta_y: float):
+        return [self.slice(*bounds) for bounds in self.segment_bounds(delta_x, delta_y)]
+
+    def segment_bounds(self, delta_x: float, delta_y: float) -> list[tuple]:
+        # Pages as (start, stop, head, tail): the points self[start:stop] preceded by
+        # head and followed by tail, the interpolated split points given as
+        # (lat, lon, x, y, dist) or None. The track is walked once, each page only
+        # looks at a window of points which grows until the page boundary is inside.
 
         delta1, delta2 = sorted([delta_x, delta_y])
 
-        geo_data = list()
-        prev_idx = 0
+        bounds = list()
+        start = 0
+        head = None
+        window = 256
 
         while True:
 
-            lat = self.lat[prev_idx:]
-            lon = self.lon[prev_idx:]
-            x = self.x[prev_idx:]
-            y = self.y[prev_idx:]
-            dist = self.dist[prev_idx:]
-            # Inserting previously interpolated coordinate
-            if prev_idx > 0:
-                lat = np.insert(lat, 0, geo_coord_interp.lat)
-                lon = np.insert(lon, 0, geo_coord_interp.lon)
-                x = np.insert(x, 0, mercator_coord_interp.x)
-                y = np.insert(y, 0, mercator_coord_interp.y)
-                dist = np.insert(dist, 0, dist_interp)
+            stop = min(start + window, self.len)
+            x = self.x[start:stop]
+            y = self.y[start:stop]
+            # Previously interpolated coordinate starts the page
+            if head != None:
+                x = np.insert(x, 0, head[2])
+                y = np.insert(y, 0, head[3])
+            offset = 0 if head == None else 1
             xspan = np.maximum.accumulate(x) - np.minimum.accumulate(x)
             yspan = np.maximum.accumulate(y) - np.minimum.accumulate(y)
             i = np.argmax(xspan > delta1)
             j = np.argmax(yspan > delta1)
-            if i == 0 and j == 0: break 
-            idx = min(i, j) if i>0 and j>0 else max(i, j)
-            delta_x = delta2 if idx == i else delta1
-            delta_y = delta1 if idx == i else delta2
-            i = np.argmax(xspan > delta_x)
-            j = np.argmax(yspan > delta_y)
+            if i > 0 or j > 0:
+                idx = min(i, j) if i>0 and j>0 else max(i, j)
+                delta_x = delta2 if idx == i else delta1
+                delta_y = delta1 if idx == i else delta2
+                i = np.argmax(xspan > delta_x)
+                j = np.argmax(yspan > delta_y)
+            if i == 0 and j == 0:
+                # Rest of the track fits on this page
+                if stop == self.len: break
+                window *= 2
+                continue
             idx = min(i, j) if i>0 and j>0 else max(i, j)
 
-            xspan1 = xspan[idx-1]
-            yspan1 = yspan[idx-1]
-            xspan2 = xspan[idx]
-            yspan2 = yspan[idx]
             mercator_coord2 = MercatorCoord(x[idx], y[idx])
             mercator_coord1 = MercatorCoord(x[idx-1], y[idx-1])
             # Interpolating x0, y0 such that xspan0 = dx or yspan0 = dy
-            t = (xspan2 - delta_x)/(xspan2 - xspan1) if idx == i else (yspan2 - delta_y)/(yspan2 - yspan1)
+            t = (xspan[idx] - delta_x)/(xspan[idx] - xspan[idx-1]) if idx == i else (yspan[idx] - delta_y)/(yspan[idx] - yspan[idx-1])
             mercator_coord_interp = mercator_coord2 - t*(mercator_coord2-mercator_coord1)
 
-            geo_coord1 = mercator_coord1.to_geo()
+            # Lat/lon of the point before the split are stored, only the split is projected back
+            geo_coord1 = GeoCoord(*head[:2]) if idx-1 < offset else GeoCoord(self.lat[start+idx-1-offset], self.lon[start+idx-1-offset])
             geo_coord_interp = mercator_coord_interp.to_geo()
-            dist_interp = dist[idx-1] + geo_coord1.dist(geo_coord_interp)
-            lat = np.append(lat[:idx], geo_coord_interp.lat)
-            lon = np.append(lon[:idx], geo_coord_interp.lon)
-            x = np.append(x[:idx], mercator_coord_interp.x)
-            y = np.append(y[:idx], mercator_coord_interp.y)
-            dist = np.append(dist[:idx], dist_interp)
-            geo_data.append(GeoData(lat, lon, x, y, dist))
-
-            if prev_idx == 0: prev_idx = idx
-            else: prev_idx += idx-1
-
-        if prev_idx == self.len-1: return geo_data
-
-        lat = np.insert(self.lat[prev_idx:], 0, geo_coord_interp.lat)
-        lon = np.insert(self.lon[prev_idx:], 0, geo_coord_interp.lon)
-        x = np.insert(self.x[prev_idx:], 0, mercator_coord_interp.x)
-        y = np.insert(self.y[prev_idx:], 0, mercator_coord_interp.y)
-        dist = np.insert(self.dist[prev_idx:], 0, dist_interp)
-        geo_data.append(GeoData(lat, lon, x, y, dist))
+            dist1 = head[4] if idx-1 < offset else self.dist[start+idx-1-offset]
+            dist_interp = dist1 + geo_coord1.dist(geo_coord_interp)
+            tail = (geo_coord_interp.lat, geo_coord_interp.lon, mercator_coord_interp.x, mercator_coord_interp.y, dist_interp)
+            bounds.append((start, start+idx-offset, head, tail))
 
-        return geo_data
+            start += idx-offset
+            head = tail
+            window = max(window, 2*idx)
+
+        if head == None: return [(0, self.len, None, None)]
+        if start == self.len-1: return bounds
+        bounds.append((start, self.len, head, None))
+
+        return bounds
+
+    def slice(self, start: int, stop: int, head: tuple=None, tail: tuple=None):
+        # Views into self unless interpolated end points are added
+        columns = list()
+        for k, column in enumerate((self.lat, self.lon, self.x, self.y, self.dist)):
+            column = column[start:stop]
+            if head != None or tail != None:
+                column = np.concatenate(([head[k]] if head != None else [], column, [tail[k]] if tail != None else []))
+            columns.append(column)
+        return GeoData(*columns)
 
     
     def find_dist(self, dist: float, interpolate: bool=True) -> GeoCoord:
-        i = np.argmax(self.dist > dist)
-        if i == 0: return None
-        geo_coord1 = GeoCoord(self.lat[i-1], self.lon[i-1])
-        geo_coord2 = GeoCoord(self.lat[i], self.lon[i])
-        if not interpolate: return geo_coord2
-        dist2 = self.dist[i]
-        def error(t):
-            error = (geo_coord2-t[0]*(geo_coord2-geo_coord1)).dist(geo_coord2) - (dist2-dist)
-            return error
-        t = np.abs(root(error, [0]).x[0])
-        geo_coord_interp = geo_coord2 - t*(geo_coord2-geo_coord1)
-        return geo_coord_interp
+        lat, lon, _, _, _ = self.find_dists([dist], interpolate)
+        if np.isnan(lat[0]): return None
+        return GeoCoord(lat[0], lon[0])
+
+    @profiled("data.find_dists")
+    def find_dists(self, dists: np.ndarray, interpolate: bool=True) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Coordinates lat, lon, x, y at each distance along the track and the angle
+        # pointing from there back to the track point ahead, NaN outside of the track
+        dists = np.asarray(dists, dtype=float)
+        # No track point ahead of any distance
+        if self.len < 2: return tuple(np.full(dists.shape, np.nan) for _ in range(5))
+        i = np.searchsorted(self.dist, dists, side="right")
+        valid = np.logical_and(i > 0, i < self.len)
+        i2 = np.where(valid, i, 1)
+        i1 = i2 - 1
+        geo_coords = self.geo_coords
+        geo_coords2 = geo_coords[i2]
+        mercator_coords2 = self.mercator_coords[i2]
+        if interpolate:
+            # Linear in lat/lon between the enclosing track points
+            t = (self.dist[i2] - dists)/(self.dist[i2] - self.dist[i1])
+            geo_coords_interp = geo_coords2 - t*(geo_coords2 - geo_coords[i1])
+            mercator_coords_interp = geo_coords_interp.to_mercator()
+        else:
+            geo_coords_interp, mercator_coords_interp = geo_coords2, mercator_coords2
+        angle = mercator_coords_interp.angle(mercator_coords2)
+        columns = (geo_coords_interp.lat, geo_coords_interp.lon, mercator_coords_interp.x, mercator_coords_interp.y, angle)
+        return tuple(np.where(valid, column, np.nan) for column in columns)
+
+
+class TrackCache:
+
+    # Directory of binary track files, one per GPX content hash, holding the lat, lon,
+    # x, y and dist columns of all tracks of the file. Files are opened as read-only
+    # memory maps, so a warm load neither parses nor projects, and processes loading
+    # the same route share its pages through the OS page cache. float32 halves the
+    # size at about a metre of precision.
+
+
+    _MAGIC = b"GPX2GUIDE-TRACKS\n"
+    _VERSION = 1
+    _ALIGN = 64
+
+
+    def __init__(self, path: str=None, dtype=np.float64) -> None:
+        if path == None: path = track_cache_dir()
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+
+    @profiled("data.track_cache")
+    def get(self, filename: str, tracks: list[int]=None) -> list[GeoData]:
+        # Same tracks as GeoData.from_gpx, parsed on the first call only
+        with open(filename, "rb") as file:
+            key = hashlib.sha256(file.read()).hexdigest()
+        path = self.track_path(key)
+        try:
+            geo_data = self.load(path)
+            self.hits += 1
+            profiler.count("tracks.hits")
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            profiler.count("tracks.misses")
+            self.save(path, GeoData.from_gpx(filename, stream=True))
+            geo_data = self.load(path)
+        return [track for i, track in enumerate(geo_data) if tracks == None or i in tracks]
+
+    def save(self, path: str, geo_data: list[GeoData]) -> None:
+        header = json.dumps({"version": self._VERSION, "dtype": self.dtype.str, "lengths": [track.len for track in geo_data]}).encode()
+        offset = -(-(len(self._MAGIC) + len(header) + 1)//self._ALIGN)*self._ALIGN
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self._MAGIC + header.ljust(offset - len(self._MAGIC) - 1) + b"\n")
+            for track in geo_data:
+                for column in (track.lat, track.lon, track.x, track.y, track.dist):
+                    file.write(np.ascontiguousarray(column, dtype=self.dtype).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> list[GeoData]:
+        with open(path, "rb") as file:
+            if file.readline() != cls._MAGIC: raise ValueError(path)
+            header = json.loads(file.readline())
+            offset = file.tell()
+        if header["version"] != cls._VERSION: raise ValueError(path)
+        total = 5*sum(header["lengths"])
+        columns = np.memmap(path, dtype=header["dtype"], mode="r", offset=offset, shape=(total,)) if total else np.empty(0, dtype=header["dtype"])
+        geo_data = list()
+        start = 0
+        for length in header["lengths"]:
+            geo_data.append(GeoData(*(columns[start + k*length:start + (k+1)*length] for k in range(5))))
+            start += 5*length
+        return geo_data
+
+    def track_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.{self.dtype.name}")
+
+
+def track_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "gpx2guide", "tracks")
+
+
+def read_gpx(filename: str, tracks: list[int]=None, ele: bool=False, time: bool=False):
+    # Incremental alternative to gpxpy.parse: yields one dict of arrays per selected
+    # <trk> while the file is still being read, and stops reading after the last one.
+    if tracks != None:
+        tracks = set(tracks)
+        if not tracks: return
+    track_idx = -1
+    selected = False
+    for event, elem in ElementTree.iterparse(filename, events=("start", "end")):
+        tag = elem.tag.rpartition("}")[2]
+        if event == "start":
+            if tag == "trk":
+                track_idx += 1
+                selected = tracks == None or track_idx in tracks
+                if selected:
+                    lat_buffer, lon_buffer, ele_buffer, time_buffer = array("d"), array("d"), array("d"), list()
+            continue
+        if tag == "trkpt" and selected:
+            lat_buffer.append(float(elem.get("lat")))
+            lon_buffer.append(float(elem.get("lon")))
+            if ele or time:
+                values = {child.tag.rpartition("}")[2]: child.text for child in elem}
+                if ele: ele_buffer.append(float(values["ele"]) if values.get("ele") else np.nan)
+                if time: time_buffer.append(_parse_time(values.get("time")))
+            elem.clear()
+        elif tag == "trkseg":
+            elem.clear()
+        elif tag == "trk":
+            elem.clear()
+            if not selected: continue
+            track = {"lat": np.frombuffer(lat_buffer), "lon": np.frombuffer(lon_buffer)}
+            if ele: track["ele"] = np.frombuffer(ele_buffer)
+            if time: track["time"] = np.array(time_buffer, dtype="datetime64[ms]")
+            yield track
+            if tracks != None:
+                tracks.discard(track_idx)
+                if not tracks: return
+
+def _parse_time(text: str) -> datetime:
+    if not text: return None
+    time = datetime.fromisoformat(text.strip())
+    if time.tzinfo != None: time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def clip_polyline(x: np.ndarray, y: np.ndarray, lims: tuple[float, float, float, float]) -> list[slice]:
+    # Parts of the polyline made of consecutive segments whose bounding box touches
+    # lims, every other segment lies entirely on one outer side of lims
+    xmin, xmax, ymin, ymax = lims
+    if x.size < 2:
+        inside = x.size == 1 and xmin <= x[0] <= xmax and ymin <= y[0] <= ymax
+        return [slice(0, x.size)] if inside else []
+    x1, x2 = x[:-1], x[1:]
+    y1, y2 = y[:-1], y[1:]
+    outside = np.logical_or.reduce((np.logical_and(x1 < xmin, x2 < xmin), np.logical_and(x1 > xmax, x2 > xmax),
+                                    np.logical_and(y1 < ymin, y2 < ymin), np.logical_and(y1 > ymax, y2 > ymax)))
+    # Runs of kept segments k..l-1 draw the points k..l
+    edges = np.diff(np.concatenate(([1], outside.astype(np.int8), [1])))
+    starts = np.flatnonzero(edges == -1)
+    stops = np.flatnonzero(edges == 1)
+    return [slice(start, stop+1) for start, stop in zip(starts, stops)]
+
+
+def simplify(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    # Douglas-Peucker, splitting all ranges of one recursion level at once. Returns the
+    # indices of the points kept.
+    n = x.size
+    if n < 3: return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    starts = np.array([0])
+    stops = np.array([n-1])
+    while starts.size:
+        lengths = stops - starts - 1
+        starts, stops, lengths = starts[lengths > 0], stops[lengths > 0], lengths[lengths > 0]
+        if not starts.size: break
+        offsets = np.cumsum(lengths) - lengths
+        points = np.repeat(starts + 1 - offsets, lengths) + np.arange(lengths.sum())
+        x1, y1 = np.repeat(x[starts], lengths), np.repeat(y[starts], lengths)
+        x2, y2 = np.repeat(x[stops], lengths), np.repeat(y[stops], lengths)
+        dx, dy = x2 - x1, y2 - y1
+        norm = np.hypot(dx, dy)
+        # Distance to the chord, or to its start if the chord is a single point
+        dist = np.where(norm > 0, np.abs(dx*(y1 - y[points]) - dy*(x1 - x[points]))/np.where(norm > 0, norm, 1), np.hypot(x[points] - x1, y[points] - y1))
+        dist_max = np.maximum.reduceat(dist, offsets)
+        split = np.minimum.reduceat(np.where(dist == np.repeat(dist_max, lengths), points, n), offsets)
+        split_mask = dist_max > tolerance
+        keep[split[split_mask]] = True
+        starts, stops = np.concatenate((starts[split_mask], split[split_mask])), np.concatenate((split[split_mask], stops[split_mask]))
+    return np.flatnonzero(keep)
+
+
+class PolylineIndex:
+
+    # Bounding boxes of runs of consecutive points of a polyline, packed in track
+    # order like the leaves of an R-tree. Neighbouring runs share their end point, so
+    # each segment lies within one run. Built once per track, a query only touches
+    # one box per run instead of every point.
+
+
+    _RUN = 64
+
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, run: int=None) -> None:
+        if run == None: run = self._RUN
+        self.size = x.size
+        self.starts = np.arange(0, max(x.size-1, 1), run) if x.size else np.arange(0)
+        self.stops = np.minimum(self.starts + run + 1, x.size)
+        if not x.size:
+            self.xmin = self.xmax = self.ymin = self.ymax = np.empty(0)
+            return
+        # Runs without their shared end point, then the end point added
+        self.xmin = np.minimum(np.minimum.reduceat(x, self.starts), x[self.stops-1])
+        self.xmax = np.maximum(np.maximum.reduceat(x, self.starts), x[self.stops-1])
+        self.ymin = np.minimum(np.minimum.reduceat(y, self.starts), y[self.stops-1])
+        self.ymax = np.maximum(np.maximum.reduceat(y, self.starts), y[self.stops-1])
+
+    def query(self, lims: tuple[float, float, float, float]) -> list[tuple[int, int]]:
+        # Point ranges [start, stop) of the consecutive runs whose box touches lims
+        xmin, xmax, ymin, ymax = lims
+        hit = np.logical_and(np.logical_and(self.xmax >= xmin, self.xmin <= xmax), np.logical_and(self.ymax >= ymin, self.ymin <= ymax))
+        edges = np.diff(np.concatenate(([0], hit.astype(np.int8), [0])))
+        firsts = np.flatnonzero(edges == 1)
+        lasts = np.flatnonzero(edges == -1) - 1
+        return [(int(self.starts[first]), int(self.stops[last])) for first, last in zip(firsts, lasts)]
@@ -0,0 +1,261 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import warnings
+from data import *
+from map import *
+from pdf import *
+from profiling import *
+
+
+def page_bounds(track: GeoData, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, lat: float=None) -> list[tuple]:
+    # The page extent in Mercator is taken at the reference latitude lat, the middle
+    # of the track by default
+    center = track.mean()
+    if lat != None: center = GeoCoord(lat, center.lon)
+    map = Map(center, scale, paper_size, dpi)
+    paper_width, paper_height = paper_size
+    dx = map.paper2mercator_dist(paper_width - 2*margin)
+    dy = map.paper2mercator_dist(paper_height - 2*margin)
+    return track.segment_bounds(dx, dy)
+
+
+def segment_track(track: GeoData, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float) -> list[GeoData]:
+    return [track.slice(*bounds) for bounds in page_bounds(track, scale, paper_size, dpi, margin)]
+
+
+def page_map(segment: GeoData, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, tile_source: TileSource=None, vector: bool=False) -> Map:
+    # Mercator is monotonic, the extent of the stored x/y is the projected extent
+    segment_dx = np.max(segment.x) - np.min(segment.x)
+    segment_dy = np.max(segment.y) - np.min(segment.y)
+    return Map(segment.mean(), scale, sorted(paper_size, reverse=bool(segment_dx>segment_dy)), dpi, tile_source=tile_source, vector=vector)
+
+
+def route_parts(track: GeoData, ranges: list[tuple[int, int]], bounds: tuple) -> list[GeoData]:
+    # Parts of the track within the point ranges, without the page's own segment
+    # given by its segment_bounds. Parts running into the segment end at its split
+    # points, like the neighbouring segments do.
+    start, stop, head, tail = bounds
+    parts = list()
+    for range_start, range_stop in ranges:
+        if range_start < start:
+            parts.append(track.slice(range_start, min(range_stop, start), tail=head if range_stop > start else None))
+        if range_stop > stop:
+            parts.append(track.slice(max(range_start, stop), range_stop, head=tail if range_start < stop else None))
+    return [part for part in parts if part.len > 1]
+
+
+def render_page(segment: GeoData, others: list[GeoData], scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, tile_source: TileSource=None, vector: bool=False) -> Image:
+    # The segment of the page solid, the other parts of the route on it dotted. With
+    # vector, those and the scalebar are drawn as PDF vectors over the tiles.
+    map = page_map(segment, scale, paper_size, dpi, tile_source, vector)
+    map.map()
+    map.route(segment, marker=True)
+    for other in others: map.route(other, dotted=True)
+    map.scalebar()
+    return map.img.page()
+
+
+def _render_page(page: int, *args) -> tuple[Image, dict]:
+    # Stages are tagged with the page, and handed back with the image so that those
+    # recorded in a pool worker end up in the parent's profiler
+    profiler.page = page
+    with profiler.stage("page"):
+        img = render_page(*args)
+    profiler.page = None
+    return img, profiler.drain() if profiler.enabled else None
+
+
+def _page_result(result: tuple[Image, dict]) -> Image:
+    img, state = result
+    if state != None: profiler.merge(state)
+    return img
+
+
+class TilePlan:
+
+    # Tiles of all pages of a guide, deduplicated over overlapping pages
+
+
+    _TILE_BYTES = 25000
+
+
+    def __init__(self, pages: list[list[tuple[int, int, int]]]) -> None:
+        self.pages = pages
+        self.keys = sorted(set(key for page in pages for key in page))
+        self.requested = sum(len(page) for page in pages)
+        self.count = len(self.keys)
+        self.estimated_bytes = self.count*self._TILE_BYTES
+
+    @classmethod
+    def from_segments(cls, segments: list[GeoData], scale: tuple[int, int], paper_size: tuple[float, float], dpi: float):
+        return cls([page_map(segment, scale, paper_size, dpi).tile_keys() for segment in segments])
+
+    def __repr__(self) -> str:
+        return f"<TilePlan pages:{len(self.pages)}, tiles:{self.count} of {self.requested} requested, ~{self.estimated_bytes/2**20:.1f} MiB>"
+
+    def prefetch(self, tile_source: TileSource=None) -> list[tuple[int, int, int]]:
+        # One bulk pass through the source's fetcher before any page is drawn
+        if tile_source == None: tile_source = default_tile_source()
+        return tile_source.prefetch(self.keys)
+
+
+def set_cache_memory(max_memory: int) -> None:
+    # Bounds the decoded tile and label sprite caches of this process together
+    default_decoded_cache().max_size = 3*max_memory//4
+    Img._sprites.max_size = max_memory//4
+
+
+def _init_worker(cache_memory: int) -> None:
+    # Forked workers start from a copy of the parent's profile, drop it
+    profiler.drain()
+    if cache_memory != None: set_cache_memory(cache_memory)
+
+
+def page_executor(workers: int, max_memory: int=None) -> concurrent.futures.ProcessPoolExecutor:
+    # With max_memory, half of it is shared out among the caches of the workers, the
+    # other half bounds the page pixels in flight in render_pages
+    cache_memory = max_memory//(2*workers) if max_memory != None else None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache_memory,))
+
+
+def plan_pages(track: GeoData, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, tile_source: TileSource=None, prefetch: bool=True, vector: bool=False, lat: float=None) -> list[tuple]:
+    # render_page arguments of every page of a track, prefixed with the page index.
+    # With prefetch the tiles of the whole guide are stored up front.
+    with profiler.stage("segment"):
+        bounds = page_bounds(track, scale, paper_size, dpi, margin, lat)
+        segments = [track.slice(*page) for page in bounds]
+    if prefetch:
+        with profiler.stage("prefetch"):
+            missing = TilePlan.from_segments(segments, scale, paper_size, dpi).prefetch(tile_source)
+        if missing: warnings.warn(f"{len(missing)} tiles could not be prefetched")
+    # Every part of the track showing on a page is drawn there, found through an
+    # index instead of testing the whole track for each page
+    with profiler.stage("index"):
+        index = PolylineIndex(track.x, track.y)
+        others = [route_parts(track, page_map(segment, scale, paper_size, dpi).route_ranges(index), page) for segment, page in zip(segments, bounds)]
+    # Without a tile source, workers use their own process default
+    return [(i, segments[i], others[i], scale, paper_size, dpi, tile_source, vector) for i in range(len(segments))]
+
+
+def render_guide(track: GeoData, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, workers: int=None, max_memory: int=None, tile_source: TileSource=None, prefetch: bool=True, executor: concurrent.futures.Executor=None, vector: bool=False):
+    # Yields the page images of a track in page order
+    pages = plan_pages(track, scale, paper_size, dpi, margin, tile_source, prefetch, vector)
+    yield from render_pages(pages, paper_size, dpi, workers, max_memory, executor)
+
+
+def render_pages(pages: list[tuple], paper_size: tuple[float, float], dpi: float, workers: int=None, max_memory: int=None, executor: concurrent.futures.Executor=None):
+    # Yields the images of pages from plan_pages in order. With workers > 1 they are
+    # rendered in a process pool, so that tile downloads of some pages overlap with
+    # drawing others. Pages in flight and the render caches stay within max_memory
+    # bytes, half each. A pool from page_executor, given the same max_memory, can be
+    # passed in to keep its warm workers across guides.
+
+    if workers == None: workers = os.cpu_count()
+    if executor == None and workers <= 1:
+        if max_memory != None: set_cache_memory(max_memory//2)
+        for page in pages:
+            yield _page_result(_render_page(*page))
+        return
+
+    window = 2*workers
+    if max_memory != None:
+        page_width, page_height = (int(dpi/2.54*paper_len) for paper_len in paper_size)
+        window = max(1, min(window, max_memory//2//(3*page_width*page_height)))
+    if executor != None:
+        yield from _render_window(executor, pages, window)
+        return
+    with page_executor(min(workers, window), max_memory) as executor:
+        yield from _render_window(executor, pages, window)
+
+
+def _render_window(executor: concurrent.futures.Executor, pages: list[tuple], window: int):
+    futures = dict()
+    for i in range(len(pages)):
+        while len(futures) < window and i + len(futures) < len(pages):
+            futures[i + len(futures)] = executor.submit(_render_page, *pages[i + len(futures)])
+        yield _page_result(futures.pop(i).result())
+
+
+def save_guide(name: str, pages, dpi: float, compression: str="jpeg") -> int:
+    # Pages are encoded into the PDF one at a time as they are produced
+    with PdfWriter(name, compression) as writer:
+        for page in pages:
+            writer.add_page(page, dpi)
+    return len(writer.pages)
+
+
+# Bump when the drawing changes, so that no page of an earlier version is reused
+_PAGE_VERSION = 6
+# Reference latitudes of an earlier run are kept while the track stays this close
+_LAT_TOLERANCE = 0.5
+
+
+def page_hash(page: tuple, tile_source: TileSource, compression: str, quality: int) -> str:
+    # Everything a rendered page depends on: its segment with the distances relative
+    # to its start, the km labels drawn on it, the other parts drawn dotted, map
+    # parameters, encoding and the versions of the tiles underneath. Labels are
+    # hashed by value and place, to a few mm, so that pages only change with theirs.
+    _, segment, others, scale, paper_size, dpi, _, vector = page
+    map = page_map(segment, scale, paper_size, dpi)
+    hash = hashlib.sha256(repr((_PAGE_VERSION, scale, tuple(paper_size), dpi, vector, compression, quality, len(others))).encode())
+    hash.update((segment.dist - segment.dist[0]).tobytes())
+    markers = [(dist, round(x, 9), round(y, 9), round(angle, 2)) for dist, x, y, angle in map.route_markers(segment)]
+    hash.update(repr(markers).encode())
+    for geo_data in (segment, *others):
+        hash.update(b"%d" % geo_data.len)
+        hash.update(geo_data.lat.tobytes())
+        hash.update(geo_data.lon.tobytes())
+    versions = tile_source.versions(map.tile_keys())
+    hash.update(repr(sorted(versions.items())).encode())
+    return hash.hexdigest()
+
+
+def update_guide(name: str, tracks: list[GeoData], scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, margin: float, workers: int=None, max_memory: int=None,
+                 tile_source: TileSource=None, compression: str="jpeg", quality: int=90, executor: concurrent.futures.Executor=None, vector: bool=False) -> dict:
+    # Writes the guide of tracks to name like save_guide, keeping the hash and the place
+    # of every page's image stream and vector overlay in name.json. On the next update,
+    # pages whose hash is unchanged are copied over from the old PDF as they are, only
+    # the others are rendered and encoded again. Pages are cut at the reference
+    # latitudes of the first run, so that an edit leaves the pages before it as they
+    # were. Pages after it still change when their split points or km labels move,
+    # which any edit changing the length of the route does.
+
+    index_name = f"{name}.json"
+    old_pages = dict()
+    lats = list()
+    if os.path.exists(name) and os.path.exists(index_name):
+        with open(index_name, "r") as file:
+            index = json.load(file)
+        if index.get("version") == _PAGE_VERSION and index.get("size") == os.path.getsize(name):
+            old_pages = {page["hash"]: page for page in index["pages"]}
+        lats = index.get("lats", list())
+    lats = [lats[k] if k < len(lats) and abs(lats[k] - track.mean().lat) <= _LAT_TOLERANCE else track.mean().lat for k, track in enumerate(tracks)]
+
+    versions_source = tile_source if tile_source != None else default_tile_source()
+    pages = [page for track, lat in zip(tracks, lats) for page in plan_pages(track, scale, paper_size, dpi, margin, tile_source, vector=vector, lat=lat)]
+    hashes = [page_hash(page, versions_source, compression, quality) for page in pages]
+    rendered = render_pages([page for page, hash in zip(pages, hashes) if hash not in old_pages], paper_size, dpi, workers, max_memory, executor)
+
+    tmp_name = f"{name}.{os.getpid()}.tmp"
+    page_infos = list()
+    try:
+        with PdfWriter(tmp_name, compression, quality) as writer:
+            for hash in hashes:
+                if hash in old_pages:
+                    old_page = old_pages[hash]
+                    data = read_stream(name, old_page["offset"], old_page["length"])
+                    overlay = read_stream(name, old_page["overlay_offset"], old_page["overlay_length"]) if "overlay_offset" in old_page else None
+                    page_info = writer.add_encoded_page(data, old_page["width"], old_page["height"], old_page["mode"], old_page["filter"], old_page["dpi"], overlay)
+                else:
+                    page_info = writer.add_page(next(rendered), dpi)
+                page_info["hash"] = hash
+                page_infos.append(page_info)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    os.replace(tmp_name, name)
+    with open(index_name, "w") as file:
+        json.dump({"version": _PAGE_VERSION, "size": os.path.getsize(name), "lats": lats, "pages": page_infos}, file)
+    return {"pages": len(hashes), "rendered": sum(hash not in old_pages for hash in hashes)}
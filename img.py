@@ -1,6 +1,58 @@
+import functools
+import os
+from collections import OrderedDict
 from io import BytesIO
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw
+from geometry import *
+from pdf import PdfOverlay
+from profiling import *
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(font: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font, size=size, encoding="unic")
+
+
+class SpriteCache:
+
+    # Process-wide LRU of rendered (box, mask, ...) label sprites, bounded by the
+    # number of pixel bytes held
+
+
+    def __init__(self, max_size: int=32*2**20) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._sprites = OrderedDict()
+
+    def get(self, key: tuple):
+        sprite = self._sprites.get(key)
+        if sprite == None:
+            self.misses += 1
+            profiler.count("sprites.misses")
+            return None
+        self.hits += 1
+        profiler.count("sprites.hits")
+        self._sprites.move_to_end(key)
+        return sprite
+
+    def put(self, key: tuple, sprite: tuple) -> None:
+        self._sprites[key] = sprite
+        self.size += self._sprite_size(sprite)
+        while self.size > self.max_size and len(self._sprites) > 1:
+            _, old_sprite = self._sprites.popitem(last=False)
+            self.size -= self._sprite_size(old_sprite)
+
+    def clear(self) -> None:
+        self._sprites.clear()
+        self.size = 0
+
+    @staticmethod
+    def _sprite_size(sprite: tuple) -> int:
+        box, mask = sprite[:2]
+        return box.width*box.height*(len(box.getbands()) + len(mask.getbands()))
 
     
 class Img:
@@ -9,11 +61,14 @@ class Img:
     _LINE_WIDTH = 1.5
     _DOTTED_LENGTH = 7.95
     _DOTTED_RATIO = 0.6
-    _FONT = "arial.ttf"
+    _FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arial.ttf")
     _FONT_SIZE = 10
     _SPACING = 2
     _STROKE_FILL = "white"
     _STROKE_WIDTH = 1
+    _ANGLE_STEP = 1
+    _SIMPLIFY_TOLERANCE = 0.25
+    _sprites = SpriteCache()
 
 
     def __init__(self, lims: tuple[float, float, float, float], paper_size: tuple[float, float], dpi: float) -> None:
@@ -23,19 +78,26 @@ class Img:
         self.width: int = self.paper2img_len(paper_width)
         self.height: int = self.paper2img_len(paper_height)
         self.img = Image.new("RGB", (self.width, self.height))
-        self.font = ImageFont.truetype(self._FONT, size=self.font2img_len(self._FONT_SIZE), encoding="unic")
+        self.font = load_font(self._FONT, self.font2img_len(self._FONT_SIZE))
 
 
+    @profiled("img.lines")
     def lines(self, x: list[float], y: list[float], color: str, line_width: float=None) -> None:
         if line_width == None: line_width = self._LINE_WIDTH
-        x = np.array(x)
-        y = np.array(y)
+        x = np.array(x, dtype=float)
+        y = np.array(y, dtype=float)
         i = self.data2img_i(x)
         j = self.data2img_j(y)
-        ij = np.array([i, j]).flatten("F").tolist()
+        # Only the parts near the image, without points closer than a fraction of a pixel to the drawn line
+        width = self.font2img_len(line_width)
+        margin = width + 1
         draw = ImageDraw.Draw(self.img)
-        draw.line(ij, fill=color, width=self.font2img_len(line_width), joint="curve")
+        for part in clip_polyline(i, j, (-margin, self.width+margin, -margin, self.height+margin)):
+            keep = simplify(i[part], j[part], self._SIMPLIFY_TOLERANCE)
+            ij = np.array([i[part][keep], j[part][keep]]).flatten("F").tolist()
+            draw.line(ij, fill=color, width=width, joint="curve")
 
+    @profiled("img.dotted")
     def dotted(self, x: list[float], y: list[float], color: str, line_width: float=None, dotted_length: float=None, dotted_ratio: float=None) -> None:
         if line_width == None: line_width = self._LINE_WIDTH
         if dotted_length == None: dotted_length = self._DOTTED_LENGTH
@@ -43,84 +105,49 @@ class Img:
 
         x = np.array(x)
         y = np.array(y)
-        slices = np.ma.clump_masked(np.ma.masked_where(np.logical_and(np.logical_and(x<self.xmax, x>self.xmin), np.logical_and(y<self.ymax, y>self.ymin)), x))
-        for slice in slices:
-            start = slice.start
-            stop = slice.stop
-            if start > 0: start -= 1
-            if stop < x.size-1: stop += 1
-
+        period = self.font2img_len(dotted_length)
+        dash = dotted_ratio*period
+        draw = ImageDraw.Draw(self.img)
+        for start, stop in self._visible_slices(x, y):
             slice_i = self.data2img_i(x[start:stop])
             slice_j = self.data2img_j(y[start:stop])
-            slice_length = np.sqrt(np.sum(np.power((slice_i - slice_j), 2)))
-            func = lambda a:  np.sqrt(np.power(a[0]-a[2], 2) + np.power(a[1]-a[3], 2))
-            delta = np.insert(np.apply_along_axis(func, 1, np.column_stack((slice_i[:-1], slice_j[:-1], slice_i[1:], slice_j[1:]))), 0, 0)
-            slice_length = np.cumsum(delta)
-
-            prev_idx = 0
-            while True:
-
-                i = slice_i[prev_idx:]
-                j = slice_j[prev_idx:]
-                length = slice_length[prev_idx:]
-                if prev_idx > 0: 
-                    i = np.insert(i, 0, i_interp)
-                    j = np.insert(j, 0, j_interp)
-                    length = np.insert(length, 0, length_interp)
-                
-                draw_length = length[0] + dotted_ratio*self.font2img_len(dotted_length)
-                idx = np.argmax(length > draw_length)
-                if idx == 0: break
-                i1 = i[idx-1]
-                j1 = j[idx-1]
-                length1 = length[idx-1]
-                i2 = i[idx]
-                j2 = j[idx]
-                length2 = length[idx]
-                t = (length2 - draw_length)/(length2 - length1)
-                i_interp = i2 - t*(i2 - i1)
-                j_interp = j2 - t*(j2 - j1)
-                # Drawing
-                ij = np.array([np.append(i[:idx], i_interp), np.append(j[:idx], j_interp)]).flatten("F").tolist()
-                draw = ImageDraw.Draw(self.img)
+            delta = np.sqrt(np.power(np.diff(slice_i), 2) + np.power(np.diff(slice_j), 2))
+            slice_length = np.concatenate(([0], np.cumsum(delta)))
+            if slice_length[-1] <= 0: continue
+
+            # Dash k covers slice_length from k*period to k*period + dash
+            dash_start = np.arange(0, slice_length[-1], period)
+            dash_stop = np.minimum(dash_start + dash, slice_length[-1])
+            lo = np.searchsorted(slice_length, dash_start, side="right")
+            hi = np.searchsorted(slice_length, dash_stop, side="right")
+            i_start = np.interp(dash_start, slice_length, slice_i)
+            j_start = np.interp(dash_start, slice_length, slice_j)
+            i_stop = np.interp(dash_stop, slice_length, slice_i)
+            j_stop = np.interp(dash_stop, slice_length, slice_j)
+            # Drawing
+            for k in range(dash_start.size):
+                i = np.concatenate(([i_start[k]], slice_i[lo[k]:hi[k]], [i_stop[k]]))
+                j = np.concatenate(([j_start[k]], slice_j[lo[k]:hi[k]], [j_stop[k]]))
+                ij = np.array([i, j]).flatten("F").tolist()
                 draw.line(ij, fill=color, width=self.font2img_len(line_width), joint="curve")
 
-                total_length = length[0] + self.font2img_len(dotted_length)
-                idx = np.argmax(length > total_length)
-                if idx == 0: break
-                i1 = i[idx-1]
-                j1 = j[idx-1]
-                length1 = length[idx-1]
-                i2 = i[idx]
-                j2 = j[idx]
-                length2 = length[idx]
-                t = (length2 - total_length)/(length2 - length1)
-                i_interp = i2 - t*(i2 - i1)
-                j_interp = j2 - t*(j2 - j1)
-                length_interp = total_length
-
-                if prev_idx == 0: prev_idx = idx
-                else: prev_idx += idx-1
-
-            ij = np.array([i, j]).flatten("F").tolist()
-            draw = ImageDraw.Draw(self.img)
-            draw.line(ij, fill=color, width=self.font2img_len(line_width), joint="curve")
+    def _visible_slices(self, x: np.ndarray, y: np.ndarray) -> list[tuple[int, int]]:
+        # Runs of points inside the limits, with the points just before and after
+        slices = list()
+        for slice in np.ma.clump_masked(np.ma.masked_where(np.logical_and(np.logical_and(x<self.xmax, x>self.xmin), np.logical_and(y<self.ymax, y>self.ymin)), x)):
+            start = slice.start
+            stop = slice.stop
+            if start > 0: start -= 1
+            if stop < x.size-1: stop += 1
+            slices.append((start, stop))
+        return slices
 
 
+    @profiled("img.text")
     def text(self, x: float, y: float, text: str, color: str, angle: float=0) -> None:
 
-        bbox = self.font.getbbox(text, stroke_width=self.font2img_len(self._STROKE_WIDTH))
-        text_width, text_height = bbox[2], bbox[3]
-        box = Image.new("RGB", (text_width, text_height))
-        mask = Image.new("L", (text_width, text_height))
-    
-        box_draw = ImageDraw.Draw(box)
-        mask_draw = ImageDraw.Draw(mask)
-        box_draw.text([0, 0], text, fill=color, font=self.font, stroke_width=self.font2img_len(self._STROKE_WIDTH), stroke_fill=self._STROKE_FILL)
-        mask_draw.text([0, 0], text, fill="white", font=self.font, stroke_fill="white", stroke_width=self.font2img_len(self._STROKE_WIDTH))
-
-        box = box.rotate(angle, Image.Resampling.BICUBIC, expand=True)
-        mask = mask.rotate(angle, Image.Resampling.BICUBIC, expand=True)
+        angle = round(angle/self._ANGLE_STEP)*self._ANGLE_STEP
+        box, mask, text_width, text_height = self._text_sprite(text, color, angle)
 
         i = self.data2img_i(x)
         j = self.data2img_j(y)
@@ -130,33 +157,63 @@ class Img:
         elif (angle-90) % 360 <= 90:
             i -=  box.width
             j -=  text_width*np.cos(np.deg2rad(angle - 90))
-            box = box.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
-            mask = mask.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
         elif (angle-180) % 360 <= 90:
             i -=  text_width*np.cos(np.deg2rad(angle - 180))
-            box = box.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
-            mask = mask.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
         else:
             j -=  text_height*np.cos(np.deg2rad(angle - 260))
         ij = [int(i), int(j)]
         self.img.paste(box, ij, mask)
 
+    def _text_sprite(self, text: str, color: str, angle: float) -> tuple:
+        stroke_width = self.font2img_len(self._STROKE_WIDTH)
+        key = ("text", text, self.font.path, self.font.size, stroke_width, self._STROKE_FILL, color, angle)
+        sprite = self._sprites.get(key)
+        if sprite != None: return sprite
+
+        bbox = self.font.getbbox(text, stroke_width=stroke_width)
+        text_width, text_height = bbox[2], bbox[3]
+        box = Image.new("RGB", (text_width, text_height))
+        mask = Image.new("L", (text_width, text_height))
+    
+        box_draw = ImageDraw.Draw(box)
+        mask_draw = ImageDraw.Draw(mask)
+        box_draw.text([0, 0], text, fill=color, font=self.font, stroke_width=stroke_width, stroke_fill=self._STROKE_FILL)
+        mask_draw.text([0, 0], text, fill="white", font=self.font, stroke_fill="white", stroke_width=stroke_width)
+
+        box = box.rotate(angle, Image.Resampling.BICUBIC, expand=True)
+        mask = mask.rotate(angle, Image.Resampling.BICUBIC, expand=True)
+        if not angle % 360 <= 90 and ((angle-90) % 360 <= 90 or (angle-180) % 360 <= 90):
+            box = box.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
+            mask = mask.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
+
+        sprite = (box, mask, text_width, text_height)
+        self._sprites.put(key, sprite)
+        return sprite
+
+    @profiled("img.annotate")
     def annotate(self, x: float, y: float, text: str, color: str, angle: float=0, distance: float=None) -> None:
+        # Labels are drawn directly, km labels hardly ever repeat for a sprite to pay off
+        i, j, anchor = self._label_anchor(x, y, angle, distance)
+        draw = ImageDraw.Draw(self.img)
+        kwargs = {"font": self.font, "anchor": anchor, "spacing": self.font2img_len(self._SPACING), "stroke_width": self.font2img_len(self._STROKE_WIDTH), "stroke_fill": self._STROKE_FILL}
+        draw.text([i, j], text, color, **kwargs)
+
+    def _label_anchor(self, x: float, y: float, angle: float, distance: float=None) -> tuple[float, float, str]:
+        # Point distance away from x, y in the direction of angle, and the side of the
+        # label facing x, y
         if distance == None: distance = self.font2img_len(self._FONT_SIZE)/2 + self.font2img_len(self._SPACING)
         i0 = self.data2img_i(x)
         j0 = self.data2img_j(y)
         i = i0 + distance*np.cos(np.deg2rad(angle))
         j = j0 - distance*np.sin(np.deg2rad(angle))
-        ij = [i, j]
-        draw = ImageDraw.Draw(self.img)
         anchors = ["lm", "ls", "ms", "rs", "rm", "rt", "mt", "lt"]
-        for i, anchor in enumerate(anchors): 
+        for k, anchor in enumerate(anchors): 
             # See https://stackoverflow.com/a/66834497
-            if (angle - (i-1/2)*45) % 360 <= 45: break
-        kwargs = {"font": self.font, "anchor": anchor, "spacing": self.font2img_len(self._SPACING), "stroke_width": self.font2img_len(self._STROKE_WIDTH), "stroke_fill": self._STROKE_FILL}
-        draw.text(ij, text, color, **kwargs)
+            if (angle - (k-1/2)*45) % 360 <= 45: break
+        return i, j, anchor
 
 
+    @profiled("img.mark")
     def mark(self, x: float, y: float, color: str, angle: float=0, length: float=None, line_width: float=None) -> None:
         if length == None: length = self.font2img_len(self._FONT_SIZE)
         if line_width == None: line_width = self._LINE_WIDTH
@@ -171,6 +228,7 @@ class Img:
         draw.line(ij, fill=color, width=self.font2img_len(line_width), joint="curve")
 
     
+    @profiled("img.paste")
     def paste(self, img: Image, lims: tuple[float, float, float, float]):
         imin = max(self.data2img_i(lims[0]), 0)
         imax = min(self.data2img_i(lims[1]), self.width)
@@ -183,7 +241,26 @@ class Img:
         img = img.resize((int(imax-imin), int(jmax-jmin)), resample=Image.Resampling.LANCZOS, box=box)
         self.img.paste(img, box=(int(imin), int(jmin))) 
 
-
+    @profiled("img.paste_tile")
+    def paste_tile(self, img: Image, lims: tuple[float, float, float, float]) -> None:
+        # Resamples img straight into the page pixels it covers. Edges are rounded to
+        # whole pixels the same way for neighbouring tiles, so they meet without gaps.
+        i0, i1 = self.data2img_i(lims[0]), self.data2img_i(lims[1])
+        j0, j1 = self.data2img_j(lims[3]), self.data2img_j(lims[2])
+        imin, imax = max(round(i0), 0), min(round(i1), self.width)
+        jmin, jmax = max(round(j0), 0), min(round(j1), self.height)
+        if imin >= imax or jmin >= jmax: return
+        box = (min(max((imin-i0)/(i1-i0)*img.width, 0), img.width),
+               min(max((jmin-j0)/(j1-j0)*img.height, 0), img.height),
+               min(max((imax-i0)/(i1-i0)*img.width, 0), img.width),
+               min(max((jmax-j0)/(j1-j0)*img.height, 0), img.height))
+        size = (imax-imin, jmax-jmin)
+        if size != img.size or box != (0, 0, img.width, img.height):
+            img = img.resize(size, resample=Image.Resampling.LANCZOS, box=box)
+        self.img.paste(img, box=(imin, jmin))
+
+
+    @profiled("img.scalebar")
     def scalebar(self, scale_len: float, scale_dist: float, unit: str) -> None:
         bar_width = self.paper2img_len(scale_len)
         bar_height = self.font2img_len(self._FONT_SIZE)
@@ -199,6 +276,9 @@ class Img:
         draw.text([bar_width, self.height-bar_height-self.font2img_len(self._SPACING)], unit, anchor="ls", **kwargs)
 
 
+    def page(self) -> Image:
+        return self.img
+
     def show(self) -> None:
         self.img.show()
 
@@ -234,6 +314,123 @@ class Img:
         return img_len
 
 
+class VectorImg(Img):
+
+    # Img over which lines, dashes, marks, labels and the scalebar are drawn as PDF
+    # vectors instead of pixels, so that they stay sharp over a basemap of low dpi
+    # and cost in proportion to their geometry. Only pasted images are rasterized.
+    # The overlay travels with the page image, in its info, to PdfWriter.add_page.
+
+
+    def __init__(self, lims: tuple[float, float, float, float], paper_size: tuple[float, float], dpi: float) -> None:
+        super().__init__(lims, paper_size, dpi)
+        self.overlay = PdfOverlay()
+
+
+    @profiled("vector.lines")
+    def lines(self, x: list[float], y: list[float], color: str, line_width: float=None) -> None:
+        if line_width == None: line_width = self._LINE_WIDTH
+        i = self.data2img_i(np.array(x, dtype=float))
+        j = self.data2img_j(np.array(y, dtype=float))
+        width = self.font2img_len(line_width)
+        margin = width + 1
+        for part in clip_polyline(i, j, (-margin, self.width+margin, -margin, self.height+margin)):
+            keep = simplify(i[part], j[part], self._SIMPLIFY_TOLERANCE)
+            self.overlay.polyline(i[part][keep], j[part][keep], color, width)
+
+    @profiled("vector.dotted")
+    def dotted(self, x: list[float], y: list[float], color: str, line_width: float=None, dotted_length: float=None, dotted_ratio: float=None) -> None:
+        # One dashed polyline per visible run, dashes are laid out by the PDF viewer
+        if line_width == None: line_width = self._LINE_WIDTH
+        if dotted_length == None: dotted_length = self._DOTTED_LENGTH
+        if dotted_ratio == None: dotted_ratio = self._DOTTED_RATIO
+        x = np.array(x)
+        y = np.array(y)
+        period = self.font2img_len(dotted_length)
+        dash = (dotted_ratio*period, (1 - dotted_ratio)*period)
+        for start, stop in self._visible_slices(x, y):
+            self.overlay.polyline(self.data2img_i(x[start:stop]), self.data2img_j(y[start:stop]), color, self.font2img_len(line_width), dash)
+
+    @profiled("vector.text")
+    def text(self, x: float, y: float, text: str, color: str, angle: float=0) -> None:
+        # Placed like the rotated sprite of Img.text
+        angle = round(angle/self._ANGLE_STEP)*self._ANGLE_STEP
+        stroke_width = self.font2img_len(self._STROKE_WIDTH)
+        left, top, text_width, text_height = self.font.getbbox(text, stroke_width=stroke_width)
+        cos, sin = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+        box_width = abs(text_width*cos) + abs(text_height*sin)
+        box_height = abs(text_width*sin) + abs(text_height*cos)
+
+        i = self.data2img_i(x)
+        j = self.data2img_j(y)
+        if angle % 360 <= 90:
+            i -=  text_height*np.cos(np.deg2rad(90 - angle))
+            j -=  box_height
+        elif (angle-90) % 360 <= 90:
+            i -=  box_width
+            j -=  text_width*np.cos(np.deg2rad(angle - 90))
+        elif (angle-180) % 360 <= 90:
+            i -=  text_width*np.cos(np.deg2rad(angle - 180))
+        else:
+            j -=  text_height*np.cos(np.deg2rad(angle - 260))
+        if not angle % 360 <= 90 and ((angle-90) % 360 <= 90 or (angle-180) % 360 <= 90):
+            angle += 180
+            cos, sin = -cos, -sin
+        # From the center of the box to the start of the baseline, rotated
+        di, dj = -text_width/2, -text_height/2 + self.font.getmetrics()[0]
+        i += box_width/2 + di*cos + dj*sin
+        j += box_height/2 - di*sin + dj*cos
+        self.overlay.text(i, j, text, self.font.size, color, angle, stroke_width, self._STROKE_FILL)
+
+    @profiled("vector.annotate")
+    def annotate(self, x: float, y: float, text: str, color: str, angle: float=0, distance: float=None) -> None:
+        i, j, anchor = self._label_anchor(x, y, angle, distance)
+        self._anchored_text(i, j, text, color, anchor)
+
+    def _anchored_text(self, i: float, j: float, text: str, color: str, anchor: str) -> None:
+        # PIL's horizontal text anchors, from the font's advance and vertical metrics
+        width = self.font.getlength(text)
+        ascent, descent = self.font.getmetrics()
+        i += {"l": 0, "m": -width/2, "r": -width}[anchor[0]]
+        j += {"a": ascent, "t": ascent, "m": (ascent - descent)/2, "s": 0, "b": -descent, "d": -descent}[anchor[1]]
+        self.overlay.text(i, j, text, self.font.size, color, 0, self.font2img_len(self._STROKE_WIDTH), self._STROKE_FILL)
+
+    @profiled("vector.mark")
+    def mark(self, x: float, y: float, color: str, angle: float=0, length: float=None, line_width: float=None) -> None:
+        if length == None: length = self.font2img_len(self._FONT_SIZE)
+        if line_width == None: line_width = self._LINE_WIDTH
+        i0 = self.data2img_i(x)
+        j0 = self.data2img_j(y)
+        di = length/2*np.cos(np.deg2rad(angle))
+        dj = length/2*np.sin(np.deg2rad(angle))
+        self.overlay.polyline(np.array([i0 - di, i0 + di]), np.array([j0 + dj, j0 - dj]), color, self.font2img_len(line_width))
+
+    @profiled("vector.scalebar")
+    def scalebar(self, scale_len: float, scale_dist: float, unit: str) -> None:
+        bar_width = self.dpi/2.54*scale_len
+        bar_height = self.font2img_len(self._FONT_SIZE)
+        line_width = self.font2img_len(self._LINE_WIDTH)
+        self.overlay.rect(0, self.height-bar_height, bar_width/4, self.height, "black")
+        self.overlay.rect(bar_width/4, self.height-bar_height, bar_width/2, self.height, "white", "black", line_width)
+        self.overlay.rect(bar_width/2, self.height-bar_height, 3*bar_width/4, self.height, "black")
+        self.overlay.rect(3*bar_width/4, self.height-bar_height, bar_width, self.height, "white", "black", line_width)
+        j = self.height-bar_height-self.font2img_len(self._SPACING)
+        self._anchored_text(0, j, "0", "black", "ls")
+        self._anchored_text(bar_width/2, j, f"{np.round(scale_dist/2,2):g}", "black", "ms")
+        self._anchored_text(bar_width, j, f"{np.round(scale_dist,2):g}", "black", "rs")
+        self._anchored_text(bar_width, j, unit, "black", "ls")
+
+
+    def page(self) -> Image:
+        self.img.info["overlay"] = self.overlay.content()
+        return self.img
+
+    # Vectors need no whole pixels
+    def font2img_len(self, font_len):
+        img_len = self.dpi/2.54*Img.font2paper_len(font_len)
+        return img_len
+
+
 if __name__ == "__main__":
     img = Img((0, 3, -5, 5), (10, 10), 500)
     r = 0.3
@@ -1,33 +1,60 @@
-from data import * 
-from map import *
+import argparse
+import os
 
 
-if __name__ == "__main__":
+def add_render_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--scale", type=int, default=20000, help="map scale 1:SCALE")
+    parser.add_argument("--paper", type=float, nargs=2, default=(14.8, 21), metavar=("WIDTH", "HEIGHT"), help="paper size in cm")
+    parser.add_argument("--dpi", type=float, default=200)
+    parser.add_argument("--margin", type=float, default=1, help="page margin in cm")
+    parser.add_argument("--tiles", help=".mbtiles file or {z}/{x}/{y}.png directory to read tiles from and store them in")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="render processes")
+    parser.add_argument("--max-memory", type=float, help="memory ceiling in MiB for the pages being rendered and the tile and label caches of all render processes")
+    parser.add_argument("--compression", choices=("jpeg", "flate"), default="jpeg")
+    parser.add_argument("--track-cache", choices=("float64", "float32", "off"), default="float64", help="keep parsed tracks in a binary cache, at this precision")
+    parser.add_argument("--incremental", action="store_true", help="only render the pages that changed since the last run, as recorded in OUTPUT.json")
+    parser.add_argument("--vector", action="store_true", help="draw route, labels and scalebar as PDF vectors over the map tiles, which then only need --dpi for the basemap")
+
+
+def open_tiles(path: str):
+    from tiles import HttpTileSource, open_tile_source
+    return open_tile_source(path, HttpTileSource()) if path != None else None
+
+
+def open_track_cache(dtype: str):
+    from data import TrackCache
+    return TrackCache(dtype=dtype) if dtype != "off" else None
+
+
+def parse_args(argv: list[str]=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Render a GPX route into a printable PDF guide of map pages")
+    parser.add_argument("gpx", help="GPX file")
+    parser.add_argument("-o", "--output", default="out.pdf", help="PDF file, out.pdf by default")
+    parser.add_argument("--tracks", type=int, nargs="+", help="track indices, all by default")
+    add_render_arguments(parser)
+    return parser.parse_args(argv)
 
-    scale = (1, 20000)
-    paper_size = (14.8, 21) #  (14.8, 21)
-    dpi = 200
-    margin = 1
-
-    filename = "gpx/jakobswege.gpx"
-    data = GeoData.from_gpx(filename)[:1]
-    maps = list()
-    for track in data:
-        map = Map(track.mean(), scale, paper_size, dpi)
-        paper_width, paper_height = paper_size
-        dx = map.paper2mercator_dist(paper_width - 2*margin)
-        dy = map.paper2mercator_dist(paper_height - 2*margin)
-        segments = track.segment(dx, dy)
-        for i, segment in enumerate(segments):
-            mercator_coord_min = segment.min().to_mercator()
-            mercator_coord_max = segment.max().to_mercator()
-            segment_dx = mercator_coord_max.x - mercator_coord_min.x
-            segment_dy = mercator_coord_max.y - mercator_coord_min.y
-            map = Map(segment.mean(), scale, sorted(paper_size, reverse=segment_dx>segment_dy), dpi)
-            map.map()
-            map.route(segment, marker=True)
-            if i>0: map.route(segments[i-1], dotted=True)
-            if i<len(segments)-1: map.route(segments[i+1], dotted=True)
-            map.scalebar()
-            maps.append(map)
-    maps[0].save("out.pdf", append_maps=maps[1:])
\ No newline at end of file
+
+def main(argv: list[str]=None) -> int:
+    args = parse_args(argv)
+
+    # numpy, PIL, requests and friends are only imported once there is work to do
+    import itertools
+    from data import GeoData
+    from guide import render_guide, save_guide, update_guide
+
+    scale = (1, args.scale)
+    paper_size = tuple(args.paper)
+    tile_source = open_tiles(args.tiles)
+    track_cache = open_track_cache(args.track_cache)
+    if track_cache != None: data = track_cache.get(args.gpx, args.tracks)
+    else: data = GeoData.from_gpx(args.gpx, tracks=args.tracks, stream=True)
+    max_memory = int(args.max_memory*2**20) if args.max_memory != None else None
+    if args.incremental:
+        return update_guide(args.output, data, scale, paper_size, args.dpi, args.margin, workers=args.workers, max_memory=max_memory, tile_source=tile_source, compression=args.compression, vector=args.vector)["pages"]
+    pages = itertools.chain.from_iterable(render_guide(track, scale, paper_size, args.dpi, args.margin, workers=args.workers, max_memory=max_memory, tile_source=tile_source, vector=args.vector) for track in data)
+    return save_guide(args.output, pages, args.dpi, args.compression)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,27 @@
-import concurrent.futures
-from engineering_notation import EngNumber
-import requests
+import functools
+import math
+import warnings
 from data import * 
 from img import *
+from profiling import *
+import projection
+from tiles import *
 from units import *
 
 
 class Map:
 
 
-    def __init__(self, geo_coord: GeoCoord, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float) -> None:
+    def __init__(self, geo_coord: GeoCoord, scale: tuple[int, int], paper_size: tuple[float, float], dpi: float, tile_source: TileSource=None, tile_cache: DecodedTileCache=None, zoom: int=None, vector: bool=False) -> None:
 
         self.geo_coord = geo_coord
         self.scale = scale
         self.paper_size = paper_size
         self.dpi = dpi
+        self.tile_source = tile_source
+        self.tile_cache = tile_cache
+        # Overlays as PDF vectors over the raster tiles, see VectorImg
+        self.vector = vector
 
         paper_width, paper_height = self.paper_size
         delta_x = self.paper2mercator_dist(paper_width)
@@ -25,50 +32,73 @@ class Map:
         ymin = mercator_coord.y - delta_y/2
         ymax = mercator_coord.y + delta_y/2
         self.lims = (xmin, xmax, ymin, ymax)
-        self.img = Img(self.lims, self.paper_size, self.dpi)
 
         zoom_max = 17
-        zoom = int(np.log2(self.scale[0]/self.scale[1]*dpi/256*4007501668/2.56*np.cos(self.geo_coord.phi)))
+        if zoom == None: zoom = int(self.native_zoom(self.scale, self.dpi, self.geo_coord.phi))
         self.zoom = min(zoom, zoom_max)
+        self._tile_range = None
 
+    @functools.cached_property
+    def img(self) -> Img:
+        # Only maps that are drawn allocate their page
+        if self.vector: return VectorImg(self.lims, self.paper_size, self.dpi)
+        return Img(self.lims, self.paper_size, self.dpi)
 
+
+    @profiled("map.route")
     def route(self, geo_data: GeoData, dotted=False, marker=False):
         if not dotted: self.img.lines(geo_data.x, geo_data.y, color="red")
         else: self.img.dotted(geo_data.x, geo_data.y, color="red")
         if not marker: return
+        for dist, x, y, angle in self.route_markers(geo_data):
+            self.img.mark(x, y, color="red", angle=angle)
+            self.img.annotate(x, y, str(dist), color="black", angle=angle)
+
+    def route_markers(self, geo_data: GeoData) -> list[tuple[int, float, float, float]]:
+        # Km labels of route as (dist, x, y, angle), every 2 cm of paper or more
         delta = int(np.ceil(self.paper2geo_dist(2)))
-        for dist in range(int(np.min(geo_data.dist)), int(np.max(geo_data.dist))+1, delta):
-            geo_coord1 = geo_data.find_dist(dist)
-            if geo_coord1 == None: continue
-            geo_coord2 = geo_data.find_dist(dist, interpolate=False)
-            mercator_coord1 = geo_coord1.to_mercator()
-            mercator_coord2 = geo_coord2.to_mercator()
-            angle = mercator_coord1.angle(mercator_coord2) + np.pi/2
-            self.img.mark(mercator_coord1.x, mercator_coord1.y, color="red", angle=np.rad2deg(angle))
-            self.img.annotate(mercator_coord1.x, mercator_coord1.y, str(dist), color="black", angle=np.rad2deg(angle))
+        dists = range(int(np.min(geo_data.dist)), int(np.max(geo_data.dist))+1, delta)
+        _, _, x, y, angle = geo_data.find_dists(dists)
+        angle = np.rad2deg(angle + np.pi/2)
+        return [marker for marker in zip(dists, x, y, angle) if not np.isnan(marker[1])]
 
+    @profiled("map.map")
     def map(self) -> None:
 
-        url = r"https://tile.opentopomap.org/{0}/{1}/{2}.png" 
-        tile1 = Tile.from_geo(MercatorCoord(self.lims[0], self.lims[2]).to_geo(), self.zoom)
-        tile2 = Tile.from_geo(MercatorCoord(self.lims[1], self.lims[3]).to_geo(), self.zoom)
-
-        tile_size = 256
-        img = Image.new(mode="RGB", size=((tile2.xmax-tile1.xmin)*tile_size, (tile1.ymax-tile2.ymin)*tile_size))
-        def paste(tile):
-            tile_url = url.format(tile.zoom, tile.x, tile.y)
-            res = requests.get(tile_url, headers={"User-Agent":"Mozilla/5.0 (Linux; Android 9; motorola one action Build/PSBS29.39-23-6; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/79.0.3945.93 Mobile Safari/537.36 Viber/13.9.0.12"})
-            tile_img = Image.open(BytesIO(res.content))
-            img.paste(tile_img, ((tile.x-tile1.xmin)*tile_size, (tile.y-tile2.ymin)*tile_size))
-        
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for x in range(tile1.xmin, tile2.xmax):
-                for y in range(tile2.ymin, tile1.ymax):
-                    executor.submit(paste, Tile(x, y, self.zoom))
-
-        self.img.paste(img, (tile1.geo_coord_min.to_mercator().x, tile2.geo_coord_max.to_mercator().x, tile1.geo_coord_min.to_mercator().y, tile2.geo_coord_max.to_mercator().y))
+        keys = self.tile_keys()
+        tile_source = self.tile_source if self.tile_source != None else default_tile_source()
+        tile_cache = self.tile_cache if self.tile_cache != None else default_decoded_cache()
+        profiler.count("tiles.requested", len(keys))
+        with profiler.stage("map.tiles"):
+            tiles = tile_cache.get_many(keys, tile_source)
+        self.missing_tiles = [key for key in keys if tiles[key] == None]
+        # Each tile goes straight into its part of the page, there is no mosaic
+        with profiler.stage("map.composite"):
+            for (zoom, x, y), tile_img in tiles.items():
+                if tile_img == None: continue
+                lims = (projection.tile2mercator_x(x, zoom), projection.tile2mercator_x(x+1, zoom), projection.tile2mercator_y(y+1, zoom), projection.tile2mercator_y(y, zoom))
+                self.img.paste_tile(tile_img, lims)
+        if self.missing_tiles:
+            warnings.warn(f"{len(self.missing_tiles)} of {len(keys)} tiles missing or undecodable at zoom {self.zoom}")
+    
+    def route_ranges(self, index: PolylineIndex) -> list[tuple[int, int]]:
+        # Point ranges of the indexed track that can show on this map
+        return index.query(self.lims)
+
+    def tile_range(self) -> tuple[Tile, Tile]:
+        if self._tile_range == None:
+            tile1 = Tile.from_mercator(MercatorCoord(self.lims[0], self.lims[2]), self.zoom)
+            tile2 = Tile.from_mercator(MercatorCoord(self.lims[1], self.lims[3]), self.zoom)
+            self._tile_range = (tile1, tile2)
+        return self._tile_range
+
+    def tile_keys(self) -> list[tuple[int, int, int]]:
+        tile1, tile2 = self.tile_range()
+        return [(self.zoom, x, y) for x in range(tile1.xmin, tile2.xmax) for y in range(tile2.ymin, tile1.ymax)]
     
+    @profiled("map.scalebar")
     def scalebar(self) -> None:
+        from engineering_notation import EngNumber
         scale_len = 4
         eng_number = str(EngNumber(self.paper2geo_dist(scale_len)*1000))
         if eng_number[-1].isalpha():
@@ -90,13 +120,13 @@ class Map:
         a, b = self.scale
         dist = b/a*paper_dist/100000
         return dist
+    haversine_delta_lon = staticmethod(projection.haversine_delta_lon)
     @staticmethod
-    def haversine_delta_lon(dist, lat):
-        # Haversine formula for delta lat = 0
-        R = 6371
-        delta_lam = np.arccos(1 - 2*np.power(np.sin(dist/(2*R)),2)/np.power(np.cos(np.deg2rad(lat)),2))
-        delta_lon = np.rad2deg(delta_lam)
-        return delta_lon
+    def native_zoom(scale, dpi, phi):
+        # Fractional zoom whose tiles have the resolution of the page. Its integer
+        # part is the default, upsampling tiles by less than 2; an integer native
+        # zoom pastes tiles without resampling.
+        return math.log2(scale[0]/scale[1]*dpi/256*4007501668/2.56*math.cos(phi))
     def geo2mercator_dist(self, geo_dist):
         delta_lon = Map.haversine_delta_lon(geo_dist, self.geo_coord.lat)
         mercator_dist = GeoCoord.geo2mercator_x(delta_lon)
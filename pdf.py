@@ -0,0 +1,161 @@
+import math
+import zlib
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageColor
+from profiling import *
+
+
+class PdfWriter:
+
+    # Multi-page PDF of full page raster images, each with an optional vector overlay,
+    # written page by page. Each page is encoded and flushed in add_page, only object
+    # offsets are kept until close.
+
+
+    _COMPRESSIONS = ("jpeg", "flate")
+
+
+    def __init__(self, name: str, compression: str="jpeg", quality: int=90) -> None:
+        if compression not in self._COMPRESSIONS: raise ValueError(compression)
+        self.compression = compression
+        self.quality = quality
+        self.file = open(name, "wb")
+        self.offsets = dict()
+        self.pages = list()
+        # Objects 1 and 2 are the catalog and the page tree, written on close
+        self.next_obj = 3
+        self.font_obj = None
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    @profiled("pdf.add_page")
+    def add_page(self, img: Image, dpi: float=72, compression: str=None) -> dict:
+        if compression == None: compression = self.compression
+        if compression not in self._COMPRESSIONS: raise ValueError(compression)
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+
+        if compression == "jpeg":
+            buffer = BytesIO()
+            img.save(buffer, "JPEG", quality=self.quality)
+            data = buffer.getvalue()
+            filter = "DCTDecode"
+        else:
+            data = zlib.compress(img.tobytes())
+            filter = "FlateDecode"
+        # Vector content of a PdfOverlay drawn over the image, see VectorImg
+        return self.add_encoded_page(data, img.width, img.height, img.mode, filter, dpi, img.info.get("overlay"))
+
+    def add_encoded_page(self, data: bytes, width: int, height: int, mode: str, filter: str, dpi: float=72, overlay: bytes=None) -> dict:
+        # Page of an already encoded image stream, e.g. one copied out of an earlier PDF.
+        # Returns where the streams were written, enough to copy them out of this one.
+        paper_width = width/dpi*72
+        paper_height = height/dpi*72
+        color_space = b"/DeviceRGB" if mode == "RGB" else b"/DeviceGray"
+
+        header = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /%s /Length %d >>\nstream\n" % (width, height, color_space, filter.encode(), len(data))
+        img_obj = self._write_obj(header + data + b"\nendstream")
+        content = b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q\n" % (paper_width, paper_height)
+        resources = b"/XObject << /Im0 %d 0 R >>" % img_obj
+        if overlay:
+            if self.font_obj == None: self.font_obj = self._write_obj(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+            resources += b" /Font << /F1 %d 0 R >>" % self.font_obj
+            # Image pixels with j pointing down
+            content += b"q %.6f 0 0 %.6f 0 %.4f cm\n" % (72/dpi, -72/dpi, paper_height)
+            overlay_start = len(content)
+            content += overlay + b"\nQ"
+        content_header = b"<< /Length %d >>\nstream\n" % len(content)
+        content_obj = self._write_obj(content_header + content + b"\nendstream")
+        page_obj = self._write_obj(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Resources << %s >> /Contents %d 0 R >>" % (paper_width, paper_height, resources, content_obj))
+        self.pages.append(page_obj)
+        self.file.flush()
+        offset = self.offsets[img_obj] + len(b"%d 0 obj\n" % img_obj) + len(header)
+        page_info = {"offset": offset, "length": len(data), "width": width, "height": height, "mode": mode, "filter": filter, "dpi": dpi}
+        if overlay:
+            page_info["overlay_offset"] = self.offsets[content_obj] + len(b"%d 0 obj\n" % content_obj) + len(content_header) + overlay_start
+            page_info["overlay_length"] = len(overlay)
+        return page_info
+
+    def close(self) -> None:
+        if self.file.closed: return
+        kids = b" ".join(b"%d 0 R" % page for page in self.pages)
+        # Overlays mark their text strokes as artifacts, see PdfOverlay.text
+        mark_info = b" /MarkInfo << /Marked true >>" if self.font_obj != None else b""
+        self._write_obj(b"<< /Type /Catalog /Pages 2 0 R%s >>" % mark_info, 1)
+        self._write_obj(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)), 2)
+        xref = self.file.tell()
+        size = self.next_obj
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for obj in range(1, size):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[obj])
+        self.file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref))
+        self.file.close()
+
+
+    def _write_obj(self, body: bytes, obj: int=None) -> int:
+        if obj == None:
+            obj = self.next_obj
+            self.next_obj += 1
+        self.offsets[obj] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % obj + body + b"\nendobj\n")
+        return obj
+
+
+class PdfOverlay:
+
+    # Vector content stream drawn over a page image by add_encoded_page, in the image's
+    # pixel coordinates with j pointing down. Text is set in the standard Helvetica,
+    # whose widths match the Arial the raster drawing measures text with.
+
+
+    def __init__(self) -> None:
+        self.ops = list()
+
+    def content(self) -> bytes:
+        return b"\n".join(self.ops)
+
+
+    def polyline(self, i: np.ndarray, j: np.ndarray, color: str, width: float, dash: tuple[float, float]=None) -> None:
+        # The dash pattern runs along the whole polyline, from its first point
+        if len(i) < 2: return
+        dash = b"[%.3f %.3f] 0 d" % dash if dash != None else b"[] 0 d"
+        points = b"".join(b"%.2f %.2f l\n" % point for point in zip(i[1:].tolist(), j[1:].tolist()))
+        self.ops.append(b"%s RG %.3f w 1 J 1 j %s\n%.2f %.2f m\n%sS" % (self._color(color), width, dash, i[0], j[0], points))
+
+    def rect(self, i0: float, j0: float, i1: float, j1: float, fill: str, outline: str=None, width: float=0) -> None:
+        # The outline is inside the rectangle, like PIL draws it
+        if outline == None:
+            self.ops.append(b"%s rg %.2f %.2f %.2f %.2f re f" % (self._color(fill), i0, j0, i1 - i0, j1 - j0))
+            return
+        i0, j0, i1, j1 = i0 + width/2, j0 + width/2, i1 - width/2, j1 - width/2
+        self.ops.append(b"%s rg %s RG %.3f w 0 J 0 j [] 0 d %.2f %.2f %.2f %.2f re B" % (self._color(fill), self._color(outline), width, i0, j0, i1 - i0, j1 - j0))
+
+    def text(self, i: float, j: float, text: str, size: float, color: str, angle: float=0, stroke_width: float=0, stroke_fill: str="white") -> None:
+        # Text starting at the baseline point i, j and running angle degrees counter
+        # clockwise, stroked first so that the stroke only shows around the glyphs.
+        # The stroke is marked as an artifact, search and extraction see the text once.
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        matrix = b"%.4f %.4f %.4f %.4f %.2f %.2f Tm" % (cos, -sin, -sin, -cos, i, j)
+        string = b"(%s) Tj" % text.encode("cp1252").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+        ops = list()
+        if stroke_width > 0:
+            ops.append(b"/Artifact BMC BT /F1 %.3f Tf %s RG %.3f w 1 J 1 j [] 0 d 1 Tr %s %s ET EMC" % (size, self._color(stroke_fill), 2*stroke_width, matrix, string))
+        ops.append(b"BT /F1 %.3f Tf %s rg 0 Tr %s %s ET" % (size, self._color(color), matrix, string))
+        self.ops.append(b" ".join(ops))
+
+
+    @staticmethod
+    def _color(color: str) -> bytes:
+        return b"%.3f %.3f %.3f" % tuple(c/255 for c in ImageColor.getrgb(color)[:3])
+
+
+def read_stream(name: str, offset: int, length: int) -> bytes:
+    with open(name, "rb") as file:
+        file.seek(offset)
+        return file.read(length)
@@ -0,0 +1,28 @@
+import argparse
+from guide import *
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fill a tile store with the tiles of a GPX route ahead of rendering")
+    parser.add_argument("gpx", help="GPX file")
+    parser.add_argument("store", help=".mbtiles file or {z}/{x}/{y}.png directory")
+    parser.add_argument("--tracks", type=int, nargs="+", help="track indices, all by default")
+    parser.add_argument("--scale", type=int, default=20000, help="map scale 1:SCALE")
+    parser.add_argument("--paper", type=float, nargs=2, default=(14.8, 21), metavar=("WIDTH", "HEIGHT"), help="paper size in cm")
+    parser.add_argument("--dpi", type=float, default=200)
+    parser.add_argument("--margin", type=float, default=1, help="page margin in cm")
+    parser.add_argument("--dry-run", action="store_true", help="only report the tiles needed")
+    args = parser.parse_args()
+
+    scale = (1, args.scale)
+    paper_size = tuple(args.paper)
+    pages = list()
+    for track in GeoData.from_gpx(args.gpx, tracks=args.tracks, stream=True):
+        segments = segment_track(track, scale, paper_size, args.dpi, args.margin)
+        pages.extend(TilePlan.from_segments(segments, scale, paper_size, args.dpi).pages)
+    plan = TilePlan(pages)
+    print(plan)
+    if not args.dry_run:
+        missing = plan.prefetch(open_tile_source(args.store, HttpTileSource()))
+        print(f"{plan.count-len(missing)} tiles in {args.store}, {len(missing)} failed")
\ No newline at end of file
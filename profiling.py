@@ -0,0 +1,105 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Profiler:
+
+    # Per-stage wall and CPU time and counters of a run. Disabled it costs one attribute
+    # check per instrumented call. Pages are tagged through the page attribute, stages
+    # recorded in pool workers are merged into the parent with merge.
+
+
+    def __init__(self, enabled: bool=False) -> None:
+        self.enabled = enabled
+        self.page = None
+        self.events = list()
+        self.counters = defaultdict(int)
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            event = {"name": name, "page": self.page, "start": start - self._origin, "wall": time.perf_counter() - start,
+                     "cpu": time.thread_time() - cpu_start, "pid": os.getpid(), "tid": threading.get_ident()}
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name: str, n: int=1) -> None:
+        if not self.enabled: return
+        with self._lock:
+            self.counters[name] += n
+
+    def drain(self) -> dict:
+        with self._lock:
+            state = {"events": self.events, "counters": dict(self.counters)}
+            self.events = list()
+            self.counters = defaultdict(int)
+        return state
+
+    def merge(self, state: dict) -> None:
+        with self._lock:
+            self.events.extend(state["events"])
+            for name, n in state["counters"].items():
+                self.counters[name] += n
+
+
+    def summary(self) -> dict:
+        stages = dict()
+        pages = dict()
+        for event in self.events:
+            targets = [stages]
+            if event["page"] != None: targets.append(pages.setdefault(event["page"], dict()))
+            for totals in targets:
+                total = totals.setdefault(event["name"], {"calls": 0, "wall": 0.0, "cpu": 0.0})
+                total["calls"] += 1
+                total["wall"] += event["wall"]
+                total["cpu"] += event["cpu"]
+        return {"stages": stages, "pages": {str(page): page_stages for page, page_stages in sorted(pages.items())}, "counters": dict(self.counters)}
+
+    def chrome_trace(self) -> dict:
+        events = [{"name": event["name"], "ph": "X", "ts": event["start"]*1e6, "dur": event["wall"]*1e6, "pid": event["pid"], "tid": event["tid"],
+                   "args": {"page": event["page"], "cpu": event["cpu"]}} for event in self.events]
+        return {"traceEvents": events, "otherData": {"counters": dict(self.counters)}}
+
+    def save(self, name: str) -> None:
+        # Chrome trace (chrome://tracing, Perfetto) for *.trace.json, summary otherwise
+        report = self.chrome_trace() if name.endswith(".trace.json") else self.summary()
+        with open(name, "w") as file:
+            json.dump(report, file, indent=1)
+
+
+profiler = Profiler()
+
+
+def profiled(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled: return func(*args, **kwargs)
+            with profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# GPX2GUIDE_PROFILE=out.json or out.trace.json profiles the whole run
+_PROFILE = os.environ.get("GPX2GUIDE_PROFILE")
+if _PROFILE:
+    profiler.enabled = True
+    _pid = os.getpid()
+    atexit.register(lambda: os.getpid() == _pid and profiler.save(_PROFILE))
@@ -0,0 +1,70 @@
+import math
+import numpy as np
+
+
+# Spherical Mercator (x = lam, y = ln tan(pi/4 + phi/2)), haversine distances and
+# the slippy map tile grid. Single values go through math, which is several times
+# cheaper than a NumPy ufunc call on a scalar, arrays through NumPy.
+
+
+EARTH_RADIUS = 6371
+
+
+def geo2mercator_x(lon):
+    if isinstance(lon, np.ndarray): return np.deg2rad(lon)
+    return math.radians(lon)
+
+def geo2mercator_y(lat):
+    if isinstance(lat, np.ndarray): return np.log(np.tan(np.deg2rad(lat)/2 + np.pi/4))
+    return math.log(math.tan(math.radians(lat)/2 + math.pi/4))
+
+
+# Inverse, closed form through the Gudermannian phi = arctan(sinh(y))
+def mercator2geo_lat(y):
+    if isinstance(y, np.ndarray): return np.rad2deg(np.arctan(np.sinh(y)))
+    return math.degrees(math.atan(math.sinh(y)))
+
+def mercator2geo_lon(x):
+    if isinstance(x, np.ndarray): return np.rad2deg(x)
+    return math.degrees(x)
+
+
+def haversine_dist(phi1, lam1, phi2, lam2):
+    if isinstance(phi1, np.ndarray) or isinstance(phi2, np.ndarray):
+        return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.sin((phi2-phi1)/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin((lam2-lam1)/2)**2))
+    return 2*EARTH_RADIUS*math.asin(math.sqrt(math.sin((phi2-phi1)/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin((lam2-lam1)/2)**2))
+
+def haversine_delta_lon(dist, lat):
+    # Haversine formula for delta lat = 0
+    delta_lam = math.acos(1 - 2*math.sin(dist/(2*EARTH_RADIUS))**2/math.cos(math.radians(lat))**2)
+    return math.degrees(delta_lam)
+
+def euclidian_dist(x1, y1, x2, y2):
+    if isinstance(x1, np.ndarray) or isinstance(x2, np.ndarray): return np.sqrt((x1-x2)**2 + (y1-y2)**2)
+    return math.sqrt((x1-x2)**2 + (y1-y2)**2)
+
+
+# Tile numbering, from Mercator without going through lat/lon
+def mercator2tile_x(x, zoom):
+    return int(math.floor((x + math.pi)/(2*math.pi)*2**zoom))
+
+def mercator2tile_y(y, zoom):
+    return int(math.floor((math.pi - y)/(2*math.pi)*2**zoom))
+
+def tile2mercator_x(x, zoom):
+    return x/2**zoom*2*math.pi - math.pi
+
+def tile2mercator_y(y, zoom):
+    return math.pi - y/2**zoom*2*math.pi
+
+def geo2tile_x(lon, zoom):
+    return mercator2tile_x(geo2mercator_x(lon), zoom)
+
+def geo2tile_y(lat, zoom):
+    return mercator2tile_y(geo2mercator_y(lat), zoom)
+
+def tile2geo_lat(y, zoom):
+    return mercator2geo_lat(tile2mercator_y(y, zoom))
+
+def tile2geo_lon(x, zoom):
+    return mercator2geo_lon(tile2mercator_x(x, zoom))
@@ -0,0 +1,513 @@
+import concurrent.futures
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from urllib.parse import urlsplit
+from PIL import Image
+from profiling import *
+
+
+class TileError(Exception):
+    pass
+
+
+class TileFetcher:
+
+    # Shared HTTP engine for all pages of a run: one pooled session, a bounded worker
+    # pool, a concurrency and rate limit per host, timeouts and retries with jittered
+    # exponential backoff. Tiles that still fail are raised as TileError and recorded
+    # in failures.
+
+
+    _HEADERS = {"User-Agent":"Mozilla/5.0 (Linux; Android 9; motorola one action Build/PSBS29.39-23-6; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/79.0.3945.93 Mobile Safari/537.36 Viber/13.9.0.12"}
+    _RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+    def __init__(self, workers: int=8, host_limit: int=4, host_rate: float=20, timeout: float=10, retries: int=3, backoff: float=0.5) -> None:
+        self.workers = workers
+        self.host_limit = host_limit
+        self.host_rate = host_rate
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = list()
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        self.session.headers.update(self._HEADERS)
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+
+    def fetch(self, url: str, check=None) -> bytes:
+        # With check, content it rejects is retried and fails like an HTTP error
+        import requests
+        host = urlsplit(url).netloc
+        semaphore = self._host(host)[0]
+        for attempt in range(self.retries+1):
+            with semaphore:
+                self._wait(host)
+                profiler.count("http.requests")
+                try:
+                    res = self.session.get(url, timeout=self.timeout)
+                    if res.status_code not in self._RETRY_STATUS:
+                        res.raise_for_status()
+                        profiler.count("http.bytes", len(res.content))
+                        if check == None or check(res.content): return res.content
+                        profiler.count("http.invalid")
+                        error = TileError(f"{url}: invalid content")
+                    else:
+                        error = TileError(f"{url}: HTTP {res.status_code}")
+                except requests.HTTPError as e:
+                    error = TileError(f"{url}: {e}")
+                    break
+                except requests.RequestException as e:
+                    error = TileError(f"{url}: {e}")
+            if attempt < self.retries:
+                time.sleep(self.backoff*2**attempt*random.uniform(0.5, 1.5))
+        with self._lock:
+            self.failures.append(error)
+        profiler.count("http.failures")
+        raise error
+
+    def submit(self, url: str, check=None) -> concurrent.futures.Future:
+        return self.executor.submit(self.fetch, url, check)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
+
+
+    def _host(self, host: str) -> list:
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = [threading.BoundedSemaphore(self.host_limit), 0.0]
+            return self._hosts[host]
+
+    def _wait(self, host: str) -> None:
+        if not self.host_rate: return
+        state = self._host(host)
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, state[1])
+            state[1] = start + 1/self.host_rate
+        if start > now: time.sleep(start - now)
+
+
+_default_fetcher = None
+def default_fetcher() -> TileFetcher:
+    global _default_fetcher
+    if _default_fetcher == None:
+        _default_fetcher = TileFetcher()
+    return _default_fetcher
+
+def _reset_fetcher() -> None:
+    # A forked child inherits the fetcher's thread pool but none of its threads, work
+    # submitted to it would never run. The child builds its own on first use.
+    global _default_fetcher
+    _default_fetcher = None
+
+os.register_at_fork(after_in_child=_reset_fetcher)
+
+
+_worker_sources = dict()
+def _worker_source(cls, *args):
+    # Sources unpickled in a render worker are opened once per process and shared by
+    # all of its pages, like the default source
+    key = (cls, args)
+    if key not in _worker_sources:
+        _worker_sources[key] = cls(*args)
+    return _worker_sources[key]
+
+
+def is_image(content: bytes) -> bool:
+    # Complete and well formed as far as PIL can tell without decoding the pixels
+    try:
+        Image.open(BytesIO(content)).verify()
+        return True
+    except Exception:
+        return False
+
+
+class TileSource:
+
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        raise NotImplementedError
+
+    def get_many(self, keys: list[tuple[int, int, int]]) -> dict:
+        return {key: self.get(*key) for key in keys}
+
+    def prefetch(self, keys: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        # Stores the keys not stored yet, returns the ones that could not be fetched.
+        # Sources without a store of their own have nothing to fill.
+        return list()
+
+    def versions(self, keys: list[tuple[int, int, int]]) -> dict:
+        # Token per key that changes whenever the stored tile does, None if unknown
+        return dict.fromkeys(keys)
+
+
+class HttpTileSource(TileSource):
+
+
+    _URL = r"https://tile.opentopomap.org/{0}/{1}/{2}.png"
+
+
+    def __init__(self, url: str=None, fetcher: TileFetcher=None) -> None:
+        self.url = url if url != None else self._URL
+        self._fetcher = fetcher
+
+    def __reduce__(self) -> tuple:
+        # Fetchers stay in their process, unpickled sources use the default one there
+        return (_worker_source, (HttpTileSource, self.url))
+
+    @property
+    def fetcher(self) -> TileFetcher:
+        # Without a fetcher of its own, the process default at the time of the request,
+        # so that a source a worker inherits through fork uses the worker's fetcher
+        return self._fetcher if self._fetcher != None else default_fetcher()
+
+    # Error pages served as 200 would otherwise end up in the caches as tiles
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        return self.fetcher.fetch(self.url.format(zoom, x, y), is_image)
+
+    def get_many(self, keys: list[tuple[int, int, int]]) -> dict:
+        futures = {key: self.fetcher.submit(self.url.format(*key), is_image) for key in keys}
+        tiles = dict()
+        for key, future in futures.items():
+            try:
+                tiles[key] = future.result()
+            except TileError:
+                tiles[key] = None
+        return tiles
+
+
+class DirTileSource(TileSource):
+
+    # Local directory of {z}/{x}/{y}.png files
+
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        try:
+            with open(self.tile_path(zoom, x, y), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def versions(self, keys: list[tuple[int, int, int]]) -> dict:
+        versions = dict()
+        for key in keys:
+            try:
+                versions[key] = os.stat(self.tile_path(*key)).st_mtime_ns
+            except FileNotFoundError:
+                versions[key] = None
+        return versions
+
+    def tile_path(self, zoom: int, x: int, y: int) -> str:
+        return os.path.join(self.path, str(zoom), str(x), f"{y}.png")
+
+
+class MbTilesSource(TileSource):
+
+    # Tiles in an MBTiles SQLite file, read with one query per zoom level of a request.
+    # With a source, missing tiles are fetched from it and stored.
+
+
+    def __init__(self, path: str, source: TileSource=None) -> None:
+        self.path = path
+        self.source = source
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Workers storing their misses in the same file wait for each other
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        self._db.commit()
+
+    def __reduce__(self) -> tuple:
+        return (_worker_source, (MbTilesSource, self.path, self.source))
+
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        return self.get_many([(zoom, x, y)])[(zoom, x, y)]
+
+    def get_many(self, keys: list[tuple[int, int, int]]) -> dict:
+        tiles = dict.fromkeys(keys)
+        for zoom in {key[0] for key in keys}:
+            xs = [x for z, x, y in keys if z == zoom]
+            rows = [self.tms_row(zoom, y) for z, x, y in keys if z == zoom]
+            with self._lock:
+                cursor = self._db.execute("SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                                          (zoom, min(xs), max(xs), min(rows), max(rows)))
+                for x, row, content in cursor:
+                    key = (zoom, x, self.tms_row(zoom, row))
+                    if key in tiles: tiles[key] = content
+        missing = [key for key, content in tiles.items() if content == None]
+        self.hits += len(tiles) - len(missing)
+        self.misses += len(missing)
+        profiler.count("mbtiles.hits", len(tiles) - len(missing))
+        profiler.count("mbtiles.misses", len(missing))
+        if self.source != None and missing:
+            fetched = self.source.get_many(missing)
+            self.put_many({key: content for key, content in fetched.items() if content})
+            tiles.update(fetched)
+        return tiles
+
+    def prefetch(self, keys: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        if self.source == None: return list()
+        stored = set()
+        for zoom in {key[0] for key in keys}:
+            with self._lock:
+                cursor = self._db.execute("SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?", (zoom,))
+                stored.update((zoom, x, self.tms_row(zoom, row)) for x, row in cursor)
+        fetched = self.source.get_many([key for key in keys if key not in stored])
+        self.put_many({key: content for key, content in fetched.items() if content})
+        return [key for key, content in fetched.items() if not content]
+
+    def put_many(self, tiles: dict) -> None:
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                                 [(zoom, x, self.tms_row(zoom, y), sqlite3.Binary(content)) for (zoom, x, y), content in tiles.items()])
+            self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+    # MBTiles rows count from the south (TMS), the inverse is the same flip
+    @staticmethod
+    def tms_row(zoom: int, y: int) -> int:
+        return (1 << zoom) - 1 - y
+
+
+class TileCache(DirTileSource):
+
+    # Persistent {z}/{x}/{y}.png store in front of another source, evicting the least
+    # recently used tiles above max_size bytes. The access time of a tile file is its
+    # LRU position, the modification time is when it was fetched.
+
+
+    def __init__(self, source: TileSource, path: str, max_size: int=2**30, max_age: float=None) -> None:
+        super().__init__(path)
+        self.source = source
+        self.max_size = max_size
+        self.max_age = max_age
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+        # Without a size limit nothing is evicted, tiles are indexed as they are used
+        # instead of scanning what may be millions of files up front
+        if self.max_size != float("inf"): self._load_index()
+
+    def __reduce__(self) -> tuple:
+        return (_worker_source, (TileCache, self.source, self.path, self.max_size, self.max_age))
+
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        content = self._get_cached((zoom, x, y))
+        if content != None: return content
+        content = self.source.get(zoom, x, y)
+        if content: self.put((zoom, x, y), content)
+        return content
+
+    def get_many(self, keys: list[tuple[int, int, int]]) -> dict:
+        tiles = {key: self._get_cached(key) for key in keys}
+        fetched = self.source.get_many([key for key, content in tiles.items() if content == None])
+        for key, content in fetched.items():
+            if content: self.put(key, content)
+        tiles.update(fetched)
+        return tiles
+
+    def put(self, key: tuple[int, int, int], content: bytes) -> None:
+        path = self.tile_path(*key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.size -= self._index.pop(key, 0)
+            self._index[key] = len(content)
+            self.size += len(content)
+            self._evict()
+
+    def prefetch(self, keys: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+        with self._lock:
+            missing = [key for key in keys if not self._find(key) or self._expired(self.tile_path(*key))]
+        fetched = self.source.get_many(missing)
+        for key, content in fetched.items():
+            if content: self.put(key, content)
+        return [key for key, content in fetched.items() if not content]
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+
+
+    def _get_cached(self, key: tuple[int, int, int]) -> bytes:
+        path = self.tile_path(*key)
+        with self._lock:
+            if self._find(key) and not self._expired(path):
+                self._index.move_to_end(key)
+                content = DirTileSource.get(self, *key)
+                if content != None:
+                    self.hits += 1
+                    profiler.count("disk.hits")
+                    try:
+                        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+                    except FileNotFoundError:
+                        pass
+                    return content
+            self.misses += 1
+        profiler.count("disk.misses")
+        return None
+
+    def _find(self, key: tuple[int, int, int]) -> bool:
+        # Tiles not in the index yet are looked up on disk: those stored by another
+        # process since the index was loaded, e.g. by the parent's prefetch for a
+        # later guide of a batch, and all tiles of an unbounded cache
+        if key in self._index: return True
+        try:
+            self._index[key] = os.stat(self.tile_path(*key)).st_size
+        except FileNotFoundError:
+            return False
+        self.size += self._index[key]
+        return True
+
+    def _load_index(self) -> None:
+        entries = list()
+        if not os.path.isdir(self.path): return
+        for z in os.scandir(self.path):
+            if not (z.is_dir() and z.name.isdigit()): continue
+            for x in os.scandir(z.path):
+                if not (x.is_dir() and x.name.isdigit()): continue
+                for y in os.scandir(x.path):
+                    name, ext = os.path.splitext(y.name)
+                    if not (ext == ".png" and name.isdigit()): continue
+                    stat = y.stat()
+                    entries.append((stat.st_atime, (int(z.name), int(x.name), int(name)), stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.size += size
+        self._evict()
+
+    def _expired(self, path: str) -> bool:
+        if self.max_age == None: return False
+        try:
+            return time.time() - os.stat(path).st_mtime > self.max_age
+        except FileNotFoundError:
+            return True
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and len(self._index) > 1:
+            self._remove(next(iter(self._index)))
+
+    def _remove(self, key: tuple[int, int, int]) -> None:
+        self.size -= self._index.pop(key)
+        try:
+            os.remove(self.tile_path(*key))
+        except FileNotFoundError:
+            pass
+
+
+class DecodedTileCache:
+
+    # In-memory LRU of decoded RGB tiles in front of a tile source, bounded by the
+    # number of pixel bytes held. One instance is shared by all maps of a process, so
+    # each tile is decoded once per run.
+
+
+    def __init__(self, max_size: int=256*2**20) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get_many(self, keys: list[tuple[int, int, int]], source: TileSource) -> dict:
+        tiles = dict()
+        with self._lock:
+            for key in keys:
+                if key in self._tiles:
+                    self._tiles.move_to_end(key)
+                    tiles[key] = self._tiles[key]
+            self.hits += len(tiles)
+            self.misses += len(keys) - len(tiles)
+        profiler.count("decoded.hits", len(tiles))
+        profiler.count("decoded.misses", len(keys) - len(tiles))
+        fetched = source.get_many([key for key in keys if key not in tiles])
+        for key, content in fetched.items():
+            tiles[key] = self.put(key, content) if content else None
+        return tiles
+
+    def put(self, key: tuple[int, int, int], content: bytes) -> Image:
+        # Content that does not decode is a missing tile, not a failed page
+        with profiler.stage("tiles.decode"):
+            try:
+                tile_img = Image.open(BytesIO(content)).convert("RGB")
+            except (OSError, SyntaxError, ValueError):
+                profiler.count("decoded.failures")
+                return None
+        with self._lock:
+            if key not in self._tiles: self.size += tile_img.width*tile_img.height*3
+            self._tiles[key] = tile_img
+            while self.size > self.max_size and len(self._tiles) > 1:
+                _, old_img = self._tiles.popitem(last=False)
+                self.size -= old_img.width*old_img.height*3
+        return tile_img
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tiles.clear()
+            self.size = 0
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "gpx2guide", "tiles")
+
+def open_tile_source(path: str, source: TileSource=None) -> TileSource:
+    # Offline source for an .mbtiles file or {z}/{x}/{y}.png directory, filled from
+    # source on misses if given
+    if path.endswith(".mbtiles"): return MbTilesSource(path, source)
+    if source != None: return TileCache(source, path, max_size=float("inf"))
+    return DirTileSource(path)
+
+_default_source = None
+def default_tile_source() -> TileSource:
+    global _default_source
+    if _default_source == None:
+        _default_source = TileCache(HttpTileSource(), cache_dir())
+    return _default_source
+
+
+_default_decoded = None
+def default_decoded_cache() -> DecodedTileCache:
+    global _default_decoded
+    if _default_decoded == None:
+        _default_decoded = DecodedTileCache()
+    return _default_decoded
+
+
+if __name__ == "__main__":
+    cache = default_tile_source()
+    print(f"{cache.path}: {len(cache._index)} tiles, {cache.size/2**20:.1f} MiB")
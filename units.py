@@ -1,14 +1,28 @@
+import math
 import numpy as np
+import projection
 
 
 class GeoCoord:
 
 
+    __slots__ = ("lat", "lon", "_phi", "_lam")
+
+
     def __init__(self, lat: float, lon: float) -> None:
         self.lat = lat
         self.lon = lon
-        self.phi = np.deg2rad(lat)
-        self.lam = np.deg2rad(lon)
+        self._phi = None
+        self._lam = None
+
+    @property
+    def phi(self) -> float:
+        if self._phi is None: self._phi = math.radians(self.lat)
+        return self._phi
+    @property
+    def lam(self) -> float:
+        if self._lam is None: self._lam = math.radians(self.lon)
+        return self._lam
     
     def __repr__(self) -> str:
         return f"<GeoCoord lat:{self.lat}, lon:{self.lon}>"
@@ -40,27 +54,18 @@ class GeoCoord:
 
 
     # Mercator projection
-    @staticmethod
-    def geo2mercator_x(lon):
-        lam = np.deg2rad(lon)
-        x = lam
-        return x
-    @staticmethod
-    def geo2mercator_y(lat):
-        phi = np.deg2rad(lat)
-        y = np.log(np.tan(phi/2 + np.pi/4))
-        return y
+    geo2mercator_x = staticmethod(projection.geo2mercator_x)
+    geo2mercator_y = staticmethod(projection.geo2mercator_y)
     # Haversine distance formula
-    @staticmethod
-    def haversine_dist(phi1, lam1, phi2, lam2):
-        R = 6371
-        dist = 2*R*np.arcsin(np.sqrt(np.power(np.sin((phi2-phi1)/2),2) + np.cos(phi1)*np.cos(phi2)*np.power(np.sin((lam2-lam1)/2),2)))
-        return dist
+    haversine_dist = staticmethod(projection.haversine_dist)
 
 
 class MercatorCoord():
 
 
+    __slots__ = ("x", "y")
+
+
     def __init__(self, x: float, y: float) -> None:
         self.x = x
         self.y = y
@@ -96,25 +101,115 @@ class MercatorCoord():
         return self.euclidian_dist(self.x, self.y, other.x, other.y)
     
     def angle(self, other) -> float:
-        return np.arctan2(self.y-other.y, self.x-other.x)
+        return math.atan2(self.y-other.y, self.x-other.x)
 
 
     # Inverse Mercator projection
-    @staticmethod
-    def mercator2geo_lat(y):
-        phi = 2*np.arctan(np.exp(y)) - np.pi/2
-        lat = np.rad2deg(phi)
-        return lat
-    @staticmethod
-    def mercator2geo_lon(x):
-        lam = x
-        lon = np.rad2deg(lam)
-        return lon
+    mercator2geo_lat = staticmethod(projection.mercator2geo_lat)
+    mercator2geo_lon = staticmethod(projection.mercator2geo_lon)
     # Euclidian distance
-    @staticmethod
-    def euclidian_dist(x1, y1, x2, y2):
-        dist = np.sqrt(np.power(x1-x2, 2) + np.power(y1-y2, 2))
-        return dist
+    euclidian_dist = staticmethod(projection.euclidian_dist)
+
+
+class GeoCoordArray:
+
+    # Columns of lat/lon with the projection, distance and arithmetic of GeoCoord
+    # applied elementwise
+
+
+    __slots__ = ("lat", "lon")
+    # Let ndarray operands defer to __rmul__
+    __array_ufunc__ = None
+
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray) -> None:
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        if not self.lat.shape == self.lon.shape: raise TypeError
+
+    @property
+    def phi(self) -> np.ndarray:
+        return np.deg2rad(self.lat)
+    @property
+    def lam(self) -> np.ndarray:
+        return np.deg2rad(self.lon)
+
+    def __repr__(self) -> str:
+        return f"<GeoCoordArray size:{self.lat.size}>"
+
+    def __len__(self) -> int:
+        return self.lat.size
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice): return GeoCoord(self.lat[idx], self.lon[idx])
+        return GeoCoordArray(self.lat[idx], self.lon[idx])
+
+    def __add__(self, other):
+        return GeoCoordArray(self.lat+other.lat, self.lon+other.lon)
+    
+    def __sub__(self, other):
+        return GeoCoordArray(self.lat-other.lat, self.lon-other.lon)
+    
+    def __rmul__(self, scalar):
+        return GeoCoordArray(scalar*self.lat, scalar*self.lon)
+
+    def __truediv__(self, scalar):
+        return GeoCoordArray(self.lat/scalar, self.lon/scalar)
+
+
+    def to_mercator(self):
+        return MercatorCoordArray(GeoCoord.geo2mercator_x(self.lon), GeoCoord.geo2mercator_y(self.lat))
+
+    def dist(self, other) -> np.ndarray:
+        return GeoCoord.haversine_dist(self.phi, self.lam, other.phi, other.lam)
+
+
+class MercatorCoordArray:
+
+    # Columns of x/y with the inverse projection, distance and angle of MercatorCoord
+    # applied elementwise
+
+
+    __slots__ = ("x", "y")
+    __array_ufunc__ = None
+
+
+    def __init__(self, x: np.ndarray, y: np.ndarray) -> None:
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        if not self.x.shape == self.y.shape: raise TypeError
+
+    def __repr__(self) -> str:
+        return f"<MercatorCoordArray size:{self.x.size}>"
+
+    def __len__(self) -> int:
+        return self.x.size
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice): return MercatorCoord(self.x[idx], self.y[idx])
+        return MercatorCoordArray(self.x[idx], self.y[idx])
+
+    def __add__(self, other):
+        return MercatorCoordArray(self.x+other.x, self.y+other.y)
+    
+    def __sub__(self, other):
+        return MercatorCoordArray(self.x-other.x, self.y-other.y)
+    
+    def __rmul__(self, scalar):
+        return MercatorCoordArray(scalar*self.x, scalar*self.y)
+
+    def __truediv__(self, scalar):
+        return MercatorCoordArray(self.x/scalar, self.y/scalar)
+
+
+    def to_geo(self) -> GeoCoordArray:
+        return GeoCoordArray(MercatorCoord.mercator2geo_lat(self.y), MercatorCoord.mercator2geo_lon(self.x))
+
+    def dist(self, other) -> np.ndarray:
+        return MercatorCoord.euclidian_dist(self.x, self.y, other.x, other.y)
+
+    def angle(self, other) -> np.ndarray:
+        return np.arctan2(self.y-other.y, self.x-other.x)
 
 
 class Tile:
@@ -127,36 +222,36 @@ class Tile:
         self.xmax = self.x + 1
         self.ymin = self.y
         self.ymax = self.y + 1
-        self.geo_coord_min = GeoCoord(self.tile2geo_lat(self.ymax, self.zoom), self.tile2geo_lon(self.xmin, self.zoom))
-        self.geo_coord_max = GeoCoord(self.tile2geo_lat(self.ymin, self.zoom), self.tile2geo_lon(self.xmax, self.zoom))
+        self.mercator_coord_min = MercatorCoord(self.tile2mercator_x(self.xmin, self.zoom), self.tile2mercator_y(self.ymax, self.zoom))
+        self.mercator_coord_max = MercatorCoord(self.tile2mercator_x(self.xmax, self.zoom), self.tile2mercator_y(self.ymin, self.zoom))
+        self.geo_coord_min = self.mercator_coord_min.to_geo()
+        self.geo_coord_max = self.mercator_coord_max.to_geo()
 
     @classmethod
     def from_geo(self, geo_coord, zoom):
         x = self.geo2tile_x(geo_coord.lon, zoom)
         y = self.geo2tile_y(geo_coord.lat, zoom)
         return Tile(x, y, zoom)
+
+    @classmethod
+    def from_mercator(self, mercator_coord, zoom):
+        x = self.mercator2tile_x(mercator_coord.x, zoom)
+        y = self.mercator2tile_y(mercator_coord.y, zoom)
+        return Tile(x, y, zoom)
     
     def __repr__(self):
         return f"<Tile x:{self.x}, y:{self.y}, coord_min:{self.geo_coord_min}, coord_max:{self.geo_coord_max}>"
 
     # Tile numbering
-    @staticmethod
-    def geo2tile_x(lon, zoom):
-        x = int(np.floor((lon+180)/360*np.power(2,zoom)))
-        return x
-    @staticmethod
-    def geo2tile_y(lat, zoom):
-        y = int(np.floor((1-np.log(np.tan(lat*np.pi/180)+1/np.cos(lat*np.pi/180))/np.pi)*np.power(2, zoom-1)))
-        return y
+    geo2tile_x = staticmethod(projection.geo2tile_x)
+    geo2tile_y = staticmethod(projection.geo2tile_y)
+    mercator2tile_x = staticmethod(projection.mercator2tile_x)
+    mercator2tile_y = staticmethod(projection.mercator2tile_y)
     # Inverse
-    @staticmethod
-    def tile2geo_lat(y, zoom):
-        lat = np.arctan(np.sinh(np.pi - y/np.power(2, zoom)*2*np.pi))*180/np.pi
-        return lat
-    @staticmethod
-    def tile2geo_lon(x, zoom):
-        lon = x/np.power(2, zoom)*360 - 180
-        return lon
+    tile2geo_lat = staticmethod(projection.tile2geo_lat)
+    tile2geo_lon = staticmethod(projection.tile2geo_lon)
+    tile2mercator_x = staticmethod(projection.tile2mercator_x)
+    tile2mercator_y = staticmethod(projection.tile2mercator_y)
 
 
 if __name__ == "__main__":